@@ -1,17 +1,26 @@
+import sys
+import time
+_started = time.perf_counter()
 import streamlit as st
 from dotenv import load_dotenv
 import logging
 
+# Before the app modules are imported: they read their settings (SEARCH_BACKEND,
+# BUCKET_ROOMS, DB_AUTO_MIGRATE, ...) from the environment at import time
+load_dotenv()
+
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
 try:
     from auth import login
-    from database import init_db, get_notifications, get_user
+    from database import ensure_db, record_startup_timing, startup_timings
+    from context import begin_request
 except ImportError as e:
     logging.error(f"Failed to import modules: {e}")
     st.error(f"Application failed to start: {e}. Please check if database.py exists and is correctly configured.")
     st.stop()
+record_startup_timing("imports_ms", (time.perf_counter() - _started) * 1000)
 
 # Page config for wide layout and visible sidebar
 st.set_page_config(
@@ -153,15 +162,18 @@ st.markdown("""
 </script>
 """ % (st.session_state.get('theme', 'light'), st.session_state.get('theme', 'light')), unsafe_allow_html=True)
 
-load_dotenv()
-
 try:
-    init_db()
+    if ensure_db():
+        # Not logged: the ERROR-level logging config would swallow it
+        print(f"Startup timings: {startup_timings}", file=sys.stderr, flush=True)
 except Exception as e:
     logging.error(f"Error initializing database: {e}")
     st.error(f"Failed to initialize database: {e}")
     st.stop()
 
+# Reads memoized for this rerun only; views use context.current_request()
+ctx = begin_request()
+
 # Initialize session state with defaults
 if "theme" not in st.session_state:
     st.session_state.theme = "light"
@@ -177,8 +189,9 @@ if "nav_choice" not in st.session_state:
 # Restore session state if username exists
 if "username" in st.session_state:
     try:
-        user = get_user(st.session_state.username)
-        if user:
+        user = ctx.get_user(st.session_state.username)
+        if user and not user.get("deleting"):
+            st.session_state.is_admin = user.get("is_admin", False)
             st.session_state.display_name = user["profile"].get("display_name", st.session_state.username)
             st.session_state.avatar = user["profile"].get("avatar", "👤")
             st.session_state.theme = user.get("settings", {}).get("theme", "light")
@@ -204,11 +217,19 @@ if "username" not in st.session_state:
 username = st.session_state.username
 display_name = st.session_state.display_name or username
 avatar = st.session_state.avatar or "👤"
+
+# Unread total: one counter lookup per rerun, shared with the views
+try:
+    notifications = ctx.get_unread_count(username)
+except Exception as e:
+    logging.error(f"Error fetching notifications: {e}")
+    notifications = 0
+
 try:
     st.markdown(f"""
     <div class="welcome-banner">
         <h2>{avatar} Welcome, {display_name}! 🚀</h2>
-        <p>Ready to dominate the chat? You've got {len(get_notifications(username))} unread messages!</p>
+        <p>Ready to dominate the chat? You've got {notifications} unread messages!</p>
     </div>
     """, unsafe_allow_html=True)
 except Exception as e:
@@ -221,22 +242,15 @@ with st.sidebar:
     st.markdown(f"**{avatar} {display_name}**")
     
     # Navigation with notification badge
-    try:
-        notifications = len(get_notifications(username))
-    except Exception as e:
-        logging.error(f"Error fetching notifications: {e}")
-        notifications = 0
+    pages = ["Home", "Chat", "Groups", "Profile", "Settings"]
+    if st.session_state.get("is_admin"):
+        pages.append("Admin")
+    current = st.session_state.nav_choice.split(" ")[0]
     choice = st.radio(
         "Navigate",
-        [
-            "Home",
-            f"Chat {'🔔' + str(notifications) if notifications > 0 else ''}",
-            "Groups",
-            "Profile",
-            "Settings"
-        ],
+        [f"Chat {'🔔' + str(notifications) if notifications > 0 else ''}" if p == "Chat" else p for p in pages],
         key="nav_radio",
-        index=["Home", "Chat", "Groups", "Profile", "Settings"].index(st.session_state.nav_choice.split(" ")[0])
+        index=pages.index(current) if current in pages else 0
     )
     
     # Update nav_choice
@@ -254,6 +268,10 @@ with st.sidebar:
             logging.error(f"Error during logout: {e}")
             st.error(f"Error during logout: {e}")
 
+    # Per-render query counters for admins
+    if st.session_state.get("is_admin"):
+        ctx.stats_slot = st.empty()
+
 # Route to pages
 choice = choice.split(" ")[0]  # Remove notification badge
 try:
@@ -272,6 +290,11 @@ try:
     elif choice == "Settings":
         from views.settings import show_settings
         show_settings()
+    elif choice == "Admin":
+        from views.admin import show_admin
+        show_admin()
 except ImportError as e:
     logging.error(f"Error importing view module: {e}")
-    st.error(f"Failed to load page: {e}")
\ No newline at end of file
+    st.error(f"Failed to load page: {e}")
+
+ctx.publish()
@@ -1,8 +1,28 @@
 import streamlit as st
-from database import create_user, get_user, check_password
+from database import create_user, get_user, check_password, get_job, job_fraction
+
+def _deletion_progress():
+    # Shown after an account deletion until its background job finishes
+    job_id = st.session_state.get("deletion_job")
+    if not job_id:
+        return
+    try:
+        job = get_job(job_id)
+    except Exception as e:
+        st.error(f"Error checking account deletion: {e}")
+        return
+    if job is None or job["state"] == "done":
+        st.success("Your account and all its data have been deleted.")
+        del st.session_state["deletion_job"]
+    elif job["state"] == "failed":
+        st.error("Account deletion stopped with an error. An admin can resume it from the Admin page.")
+    else:
+        st.progress(job_fraction(job), text=f"Deleting account data… ({job['step'].replace('_', ' ')})")
+        st.button("Check progress", key="deletion_refresh")
 
 def login():
     st.title("Login to Big Boss Chat")
+    _deletion_progress()
     with st.form("login_form"):
         username = st.text_input("Username")
         password = st.text_input("Password", type="password")
@@ -10,7 +30,7 @@ def login():
         if submitted:
             try:
                 user = get_user(username)
-                if user and check_password(user["password_hash"], password):
+                if user and not user.get("deleting") and check_password(user["password_hash"], password):
                     st.session_state.username = username
                     st.session_state.display_name = user["profile"].get("display_name", username)
                     st.session_state.avatar = user["profile"].get("avatar", "👤")
@@ -58,7 +78,7 @@ def signup():
 
 def logout():
     # Selectively clear auth-related keys
-    keys_to_clear = ["username", "display_name", "avatar"]
+    keys_to_clear = ["username", "display_name", "avatar", "is_admin"]
     for key in keys_to_clear:
         if key in st.session_state:
             del st.session_state[key]
\ No newline at end of file
@@ -0,0 +1,66 @@
+import argparse
+import json
+import sys
+
+# Compare two benchmark JSON files and flag regressions, e.g.
+#   python -m benchmarks.compare base.json head.json --threshold 1.2
+
+
+def _flatten(node, prefix=""):
+    # Yields (path, stats) for every leaf result that has a p50
+    if isinstance(node, dict):
+        if "p50_ms" in node:
+            yield prefix, node
+            return
+        for key, value in node.items():
+            yield from _flatten(value, f"{prefix}/{key}" if prefix else key)
+
+
+def _errors(node, prefix=""):
+    # Yields (path, message) for every scenario that raised
+    if isinstance(node, dict):
+        if "error" in node:
+            yield prefix, node["error"]
+            return
+        for key, value in node.items():
+            yield from _errors(value, f"{prefix}/{key}" if prefix else key)
+
+
+def compare(base, head, threshold):
+    base_rows = dict(_flatten(base["results"]))
+    rows, regressions = [], []
+    for path, stats in _flatten(head["results"]):
+        old = base_rows.get(path)
+        if not old or not old["p50_ms"]:
+            continue
+        ratio = stats["p50_ms"] / old["p50_ms"]
+        rows.append((path, old["p50_ms"], stats["p50_ms"], ratio))
+        if ratio > threshold:
+            regressions.append(path)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=1.2, help="p50 ratio that counts as a regression")
+    args = parser.parse_args(argv)
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    rows, regressions = compare(base, head, args.threshold)
+    print(f"{'benchmark':60} {'base p50':>10} {'head p50':>10} {'ratio':>7}")
+    for path, old, new, ratio in rows:
+        flag = "  <-- regression" if path in regressions else ""
+        print(f"{path:60} {old:10.2f} {new:10.2f} {ratio:7.2f}{flag}")
+    errors = list(_errors(head["results"]))
+    for path, message in errors:
+        print(f"{path:60} error: {message}")
+    return 1 if regressions or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import argparse
+import json
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+from records import Message
+from benchmarks.seed import WORDS
+from benchmarks.run import git_commit
+
+# Per-session footprint of cached conversation state: raw pymongo documents
+# versus records.Message, e.g.
+#   python -m benchmarks.memory --sizes 50,500,5000 --out memory.json
+# Needs no database; documents are shaped like what find() returns, with a
+# fresh sender string per document just as BSON decoding produces.
+
+SENDERS = [f"user{i:06d}" for i in range(50)]
+
+
+def make_docs(n, rng):
+    start = datetime.utcnow() - timedelta(days=1)
+    docs = []
+    for i in range(n):
+        ts = start + timedelta(seconds=i)
+        sender = "".join(rng.choice(SENDERS))  # distinct object, like a decoded BSON string
+        doc = {
+            "_id": ObjectId(),
+            "sender": sender,
+            "group": "".join("3D Chat"),
+            "conversation_key": "".join("g:3D Chat"),
+            "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 16))),
+            "timestamp": ts,
+            "updated_at": ts,
+            "file_id": None,
+            "read": rng.random() < 0.8,
+            "reactions": {},
+        }
+        if rng.random() < 0.1:
+            doc["reactions"] = {"👍": 1}
+            doc["reactors"] = {"👍": ["".join(rng.choice(SENDERS))]}
+        docs.append(doc)
+    return docs
+
+
+def footprint(build):
+    # Bytes still allocated after build() returns, i.e. what a session keeps
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = build()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return size
+
+
+def measure(n, rng_seed):
+    # Both sides build their documents inside the measurement so records are
+    # charged for the content strings and ids they keep; the docs themselves
+    # are garbage once from_docs returns, as after a real page load
+    docs_bytes = footprint(lambda: make_docs(n, random.Random(rng_seed)))
+    records_bytes = footprint(lambda: Message.from_docs(make_docs(n, random.Random(rng_seed))))
+    return {
+        "messages": n,
+        "dict_bytes": docs_bytes,
+        "record_bytes": records_bytes,
+        "dict_bytes_per_message": round(docs_bytes / n, 1),
+        "record_bytes_per_message": round(records_bytes / n, 1),
+        "ratio": round(records_bytes / docs_bytes, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.memory")
+    parser.add_argument("--sizes", default="50,500,5000", help="comma-separated cached message counts")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="write JSON results here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for n in (int(x) for x in args.sizes.split(",")):
+        results[str(n)] = measure(n, args.seed)
+        print(f"[{n}] {json.dumps(results[str(n)])}", file=sys.stderr)
+    report = {
+        "meta": {"commit": git_commit(), "started_at": datetime.utcnow().isoformat() + "Z", "seed": args.seed},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
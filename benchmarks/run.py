@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pymongo.errors import OperationFailure
+
+import database
+from benchmarks.seed import seed, SCALES
+
+# Reproducible benchmarks against a throwaway database, e.g.
+#   python -m benchmarks.run --backend mongomock --scales small
+#   python -m benchmarks.run --backend mongod --uri mongodb://localhost:27017 --scales small,medium --out bench.json
+# mongomock is optional (pip install mongomock); scenarios a backend can't run
+# (e.g. $text search on mongomock) are reported as skipped.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+    return {
+        "n": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3),
+        "p50_ms": round(pick(0.50), 3),
+        "p95_ms": round(pick(0.95), 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def timed(fn, repeat):
+    samples = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def connect(backend, uri):
+    if backend == "mongomock":
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(uri, event_listeners=[database.query_counter, database.metrics_registry])
+    db_name = f"bench_{datetime.utcnow():%Y%m%d%H%M%S}"
+    database.use_client(client, db_name)
+    database.NOTIFY_ASYNC = False  # measure the full fan-out on the calling thread
+    return client, db_name
+
+
+# Scenarios: each takes the seed summary and returns a result dict
+def bench_create_message(data, rng, repeat):
+    big = data["members"]["3D Chat"]
+    users = data["users"]
+    return {
+        "group_3d_chat": dict(timed(lambda i: database.create_message(rng.choice(big), group="3D Chat", content=f"bench {i}"), repeat),
+                              recipients=len(big) - 1),
+        "private": timed(lambda i: database.create_message(rng.choice(users), receiver=rng.choice(users), content=f"bench {i}"), repeat),
+    }
+
+
+def bench_group_pagination(data, rng, repeat, depths=(1, 10, 50)):
+    # Latency of fetching page N of the busiest room, walking there with cursors
+    out = {}
+    for depth in depths:
+        samples = []
+        for _ in range(max(1, repeat // 4)):
+            cursor, ms = None, 0.0
+            for page in range(depth):
+                started = time.perf_counter()
+                _, cursor = database.get_group_conversation("3D Chat", cursor=cursor, limit=50)
+                ms = (time.perf_counter() - started) * 1000
+                if cursor is None:
+                    break
+            samples.append(ms)
+        out[f"page_{depth}"] = summarize(samples)
+    return out
+
+
+def bench_bucket_pagination(data, rng, repeat):
+    # group_pagination for the busiest room, one document per message versus
+    # BUCKET_SIZE-message buckets
+    rooms = database.BUCKET_ROOMS
+    try:
+        database.BUCKET_ROOMS = ""
+        out = {"per_message": bench_group_pagination(data, rng, repeat)}
+        database.BUCKET_ROOMS = "3D Chat"
+        started = time.perf_counter()
+        out["buckets_written"] = database.rebuild_buckets("3D Chat")
+        out["rebuild_s"] = round(time.perf_counter() - started, 2)
+        out["bucketed"] = bench_group_pagination(data, rng, repeat)
+        return out
+    finally:
+        database.BUCKET_ROOMS = rooms
+
+
+def bench_search(data, rng, repeat):
+    return {
+        "group": timed(lambda i: database.search_messages(rng.choice(["cache", "release bug", "coffee"]), data["users"][0], g="3D Chat"), repeat),
+        "private": timed(lambda i: database.search_messages("hello", data["users"][0], p=data["users"][1]), repeat),
+        "all_conversations": timed(lambda i: database.search_messages("release bug", data["users"][0]), repeat),
+    }
+
+
+def bench_search_backends(data, rng, repeat):
+    # Same queries against the Mongo $text index and the SQLite sidecar, plus
+    # the on-disk size of each index
+    import tempfile
+    import search_index
+    queries = ["cache", "release bug", "coffee", "deplo"]
+    user = data["users"][0]
+    backend = database.SEARCH_BACKEND
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_search_"), "search_index.db")
+    try:
+        out = {}
+        try:
+            database.SEARCH_BACKEND = "mongo"
+            out["mongo"] = timed(lambda i: database.search_messages(queries[i % len(queries)], user, g="3D Chat"), repeat)
+        except NotImplementedError as e:
+            out["mongo"] = {"skipped": str(e)}
+        else:
+            try:
+                out["mongo_index_bytes"] = database.get_db().command("collStats", "messages")["indexSizes"].get("content_text")
+            except OperationFailure as e:
+                out["mongo_index_bytes"] = None
+                out["mongo_index_error"] = str(e)
+        started = time.perf_counter()
+        index = search_index.get_index(path)
+        index.rebuild(database.messages_coll)
+        out["sqlite_build_s"] = round(time.perf_counter() - started, 2)
+        out["sqlite_index_bytes"] = index.size_bytes()
+        database.SEARCH_BACKEND = "sqlite"
+        out["sqlite"] = timed(lambda i: database.search_messages(queries[i % len(queries)], user, g="3D Chat"), repeat)
+        out["sqlite_all_conversations"] = timed(lambda i: database.search_messages(queries[i % len(queries)], user), repeat)
+        return out
+    finally:
+        database.SEARCH_BACKEND = backend
+
+
+def bench_delete_user(data, rng, repeat):
+    # Busy users sit at the head of the Zipf distribution
+    victims = iter(data["users"][1:repeat + 1])
+    return timed(lambda i: database.delete_user(next(victims), wait=True), repeat)
+
+
+def bench_show_chat(data, rng, repeat):
+    from streamlit.testing.v1 import AppTest
+    user = data["members"]["3D Chat"][-1]
+
+    def render(i):
+        at = AppTest.from_file(APP_PATH, default_timeout=120)
+        at.session_state["username"] = user
+        at.session_state["nav_choice"] = "Chat"
+        at.session_state["chat_mode"] = "group"
+        at.session_state["chat_group"] = "3D Chat"
+        at.session_state["auto_refresh"] = False
+        at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+
+    return timed(render, repeat)
+
+
+SCENARIOS = {
+    "create_message": bench_create_message,
+    "group_pagination": bench_group_pagination,
+    "bucket_pagination": bench_bucket_pagination,
+    "search_messages": bench_search,
+    "search_backends": bench_search_backends,
+    "show_chat": bench_show_chat,
+    "delete_user": bench_delete_user,  # last: it removes seeded users
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def run_scale(scale, args):
+    client, db_name = connect(args.backend, args.uri)
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    data = seed(scale, rng_seed=args.seed)
+    result = {"seed_s": round(time.perf_counter() - started, 2)}
+    try:
+        for name, fn in SCENARIOS.items():
+            if args.only and name not in args.only:
+                continue
+            try:
+                result[name] = fn(data, rng, args.repeat)
+            except NotImplementedError as e:
+                result[name] = {"skipped": f"not supported by {args.backend}: {e}"}
+            except Exception as e:
+                result[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"[{scale}] {name}: {json.dumps(result[name])}", file=sys.stderr)
+    finally:
+        if not args.keep:
+            client.drop_database(db_name)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--backend", choices=["mongomock", "mongod"], default="mongomock")
+    parser.add_argument("--uri", default=os.getenv("BENCH_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--scales", default="small", help=f"comma-separated: {', '.join(SCALES)}")
+    parser.add_argument("--only", type=lambda s: s.split(","), help="comma-separated scenario names")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark database")
+    parser.add_argument("--out", help="write JSON results here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "backend": args.backend,
+            "python": platform.python_version(),
+            "started_at": datetime.utcnow().isoformat() + "Z",
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": {scale: run_scale(scale, args) for scale in args.scales.split(",")},
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    # A scenario that raised must fail the run rather than vanish from compare
+    failed = [f"{scale}/{name}" for scale, result in report["results"].items()
+              for name, stats in result.items() if isinstance(stats, dict) and "error" in stats]
+    if failed:
+        print(f"scenarios failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import os
+import random
+from datetime import datetime, timedelta
+from bson import ObjectId
+from passlib.hash import bcrypt
+
+import database
+
+# Dataset sizes; message volume per room/user follows a Zipf-like skew so a
+# few rooms (like "3D Chat") and a few users carry most of the traffic
+SCALES = {
+    "small":  {"users": 200,    "groups": 10,  "messages": 5_000},
+    "medium": {"users": 2_000,  "groups": 50,  "messages": 50_000},
+    "large":  {"users": 10_000, "groups": 200, "messages": 500_000},
+}
+ZIPF_S        = 1.1
+GROUP_SHARE   = 0.7    # fraction of messages posted to groups
+BATCH_SIZE    = 5_000
+WORDS = ("hello world chat room message render index query cache mongo stream "
+         "benchmark latency pizza weekend meeting deploy release bug fix coffee").split()
+
+
+def zipf_weights(n, s=ZIPF_S):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def _sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 16)))
+
+
+def seed(scale, rng_seed=42):
+    # Writes directly with insert_many (bypassing create_message) so seeding a
+    # large scale takes seconds; returns a summary used by the scenarios
+    cfg = SCALES[scale] if isinstance(scale, str) else scale
+    rng = random.Random(rng_seed)
+    # ensure_db creates the admin account; don't depend on the caller's env
+    os.environ.setdefault("ADMIN_USERNAME", "bench_admin")
+    os.environ.setdefault("ADMIN_PASSWORD", "bench")
+    database.ensure_db()
+
+    pw = bcrypt.hash("bench")
+    users = [f"user{i:06d}" for i in range(cfg["users"])]
+    for i in range(0, len(users), BATCH_SIZE):
+        database.users_coll.insert_many([{
+            "username": u, "password_hash": pw, "is_admin": False,
+            "profile": {"name": u, "bio": "", "pic": None, "show_bio": False, "show_pic": False,
+                        "display_name": u.title(), "avatar": "👤"},
+            "visible_fields": [], "settings": {"theme": "light", "background_color": "#f0f0f0"},
+            "created_at": datetime.utcnow()
+        } for u in users[i:i + BATCH_SIZE]], ordered=False)
+
+    # Group sizes are skewed too: the first group contains every user
+    groups = ["3D Chat"] + [f"room{i:04d}" for i in range(1, cfg["groups"])]
+    members = {}
+    for rank, g in enumerate(groups, start=1):
+        size = max(3, int(len(users) / rank ** 0.8))
+        members[g] = users[:size] if rank == 1 else rng.sample(users, min(size, len(users)))
+    database.groups_coll.update_one({"name": "3D Chat"}, {"$set": {"members": members["3D Chat"]}})
+    database.groups_coll.insert_many([
+        {"name": g, "creator": members[g][0], "members": members[g], "is_public": False, "created_at": datetime.utcnow()}
+        for g in groups[1:]
+    ])
+
+    user_w, group_w = zipf_weights(len(users)), zipf_weights(len(groups))
+    start = datetime.utcnow() - timedelta(days=365)
+    step = timedelta(days=365) / cfg["messages"]
+    batch = []
+    for i in range(cfg["messages"]):
+        ts = start + step * i
+        if rng.random() < GROUP_SHARE:
+            g = rng.choices(groups, group_w)[0]
+            doc = {"sender": rng.choice(members[g]), "group": g}
+        else:
+            a, b = rng.choices(users, user_w, k=2)
+            if a == b:
+                b = users[(users.index(a) + 1) % len(users)]
+            doc = {"sender": a, "receiver": b}
+        doc.update({
+            "_id": ObjectId(),
+            "content": _sentence(rng), "timestamp": ts, "updated_at": ts, "file_id": None,
+            "read": rng.random() < 0.8, "reactions": {}
+        })
+        doc["conversation_key"] = database.message_conversation_key(doc)
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            database.messages_coll.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        database.messages_coll.insert_many(batch, ordered=False)
+    database.rebuild_conversations()
+
+    return {**cfg, "users": users, "groups": groups, "members": members}
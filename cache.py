@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Sentinel so a cached None (e.g. unknown user) is distinguishable from a miss
+MISSING = object()
+
+
+class LRUCache:
+    # Thread-safe LRU cache shared by every Streamlit session in the process.
+    # Entries expire after `ttl` seconds (None = never) and the cache holds at
+    # most `maxsize` entries.  With a `weigher` (e.g. len for bytes) the sum of
+    # entry weights is also kept under `maxweight`.
+    def __init__(self, maxsize=1024, ttl=None, maxweight=None, weigher=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigher = weigher
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires, weight = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.weight -= weight
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=MISSING):
+        # Lookup that neither refreshes recency nor counts as a hit or miss
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[1] is not None and item[1] < time.monotonic()):
+                return default
+            return item[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        weight = self.weigher(value) if self.weigher else 0
+        if self.maxweight is not None and weight > self.maxweight:
+            return  # never worth evicting everything for a single entry
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.weight -= old[2]
+            self._data[key] = (value, expires, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+                _, (_, _, w) = self._data.popitem(last=False)
+                self.weight -= w
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.weight -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,91 @@
+import time
+import logging
+import streamlit as st
+import database
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class RequestContext:
+    # Read-through memo for one script run: app.py and every view share it, so
+    # the same user/notification/room lookups hit the database once per rerun
+    def __init__(self):
+        self._memo = {}
+        self.started = time.perf_counter()
+        self.queries_at_start = database.query_counter.count()
+        self.calls = 0
+        self.hits = 0
+        self.stats_slot = None
+        self.timings = {}
+
+    def _read(self, fn, *args):
+        key = (fn.__name__,) + args
+        if key in self._memo:
+            self.hits += 1
+            return self._memo[key]
+        self.calls += 1
+        value = self._memo[key] = fn(*args)
+        return value
+
+    def get_user(self, username):
+        return self._read(database.get_user, username)
+
+    def get_notifications(self, username, limit=0):
+        return self._read(database.get_notifications, username, limit)
+
+    def get_unread_count(self, username):
+        return self._read(database.get_unread_count, username)
+
+    def list_rooms(self, username):
+        return self._read(database.list_rooms, username)
+
+    def get_user_groups(self, username):
+        return self._read(database.get_user_groups, username)
+
+    def invalidate(self, name=None, *args):
+        # Drop memoized reads after a write, e.g. invalidate("get_user", u)
+        if name is None:
+            self._memo.clear()
+            return
+        for key in [k for k in self._memo if k[0] == name and (not args or k[1:len(args) + 1] == args)]:
+            del self._memo[key]
+
+    def record_timing(self, name, ms, note=""):
+        # Named section timings shown next to the totals, e.g. message rendering
+        self.timings[name] = (round(ms, 1), note)
+
+    def queries(self):
+        return database.query_counter.count() - self.queries_at_start
+
+    def stats(self):
+        return {
+            "queries": self.queries(),
+            "memo_hits": self.hits,
+            "memo_misses": self.calls,
+            "render_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "timings": dict(self.timings),
+        }
+
+    def publish(self):
+        # Shows the per-render counters to admins (see app.py)
+        if self.stats_slot is not None:
+            s = self.stats()
+            sections = "".join(f" · {name} {ms} ms" + (f" ({note})" if note else "")
+                               for name, (ms, note) in s["timings"].items())
+            self.stats_slot.caption(
+                f"{s['queries']} queries · {s['memo_hits']} deduplicated · {s['render_ms']} ms{sections}"
+            )
+
+
+def begin_request():
+    ctx = RequestContext()
+    st.session_state._request_ctx = ctx
+    return ctx
+
+
+def current_request():
+    ctx = st.session_state.get("_request_ctx")
+    if ctx is None:
+        ctx = begin_request()
+    return ctx
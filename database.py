@@ -1,38 +1,254 @@
-import os, io
-from datetime import datetime
-from pymongo import MongoClient
+import os, io, re
+import mimetypes
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pymongo import MongoClient, UpdateOne, ReadPreference, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError
 from passlib.hash import bcrypt
 from bson import ObjectId
+import gridfs
+from gridfs.errors import FileExists, NoFile
 import logging
+from cache import LRUCache, MISSING
+from metrics import instrumented, registry as metrics_registry
+import search_index
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are skipped when Pillow is not installed
+    Image = None
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load env
-MONGO_URI     = os.getenv("MONGO_URI")
-MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
-client        = MongoClient(MONGO_URI)
-db            = client[MONGO_DB_NAME]
+# Client management
+# The client is built on first use (not at import), from env read at that
+# moment, so importing this module never opens a connection
+_READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+_client      = None
+_client_lock = threading.Lock()
+_client_gen  = 0     # bumped by use_client so lazy collections re-resolve
+_db_name     = None  # overrides MONGO_DB_NAME when set by use_client
+
+class _PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.counts = {"pools": 0, "open": 0, "checked_out": 0, "checkout_failed": 0}
+        self._lock = threading.Lock()
+
+    def _add(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def pool_created(self, event): self._add("pools")
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): self._add("pools", -1)
+    def connection_created(self, event): self._add("open")
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): self._add("open", -1)
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): self._add("checkout_failed")
+    def connection_checked_out(self, event): self._add("checked_out")
+    def connection_checked_in(self, event): self._add("checked_out", -1)
+
+pool_stats = _PoolStats()
+
+class _QueryCounter(monitoring.CommandListener):
+    # Commands run synchronously on the caller's thread, and each Streamlit
+    # session runs its script on its own thread, so a thread-local count is
+    # the number of queries the current page render issued
+    def __init__(self):
+        self._local = threading.local()
+
+    def started(self, event):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def succeeded(self, event): pass
+    def failed(self, event): pass
+
+    def count(self):
+        return getattr(self._local, "count", 0)
+
+query_counter = _QueryCounter()
+
+def client_options():
+    return {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "10000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000")),
+        "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000")),
+        "readPreference": os.getenv("MONGO_READ_PREFERENCE", "primary"),
+    }
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(os.getenv("MONGO_URI"), event_listeners=[pool_stats, query_counter, metrics_registry], **client_options())
+    return _client
+
+def get_db():
+    return get_client()[_db_name or os.getenv("MONGO_DB_NAME")]
+
+def use_client(client, db_name=None):
+    # Swap in another client (a local mongod or mongomock stand-in for
+    # benchmarks); process caches and the bootstrap flag are reset with it
+    global _client, _client_gen, _db_name, _bootstrapped
+    with _client_lock:
+        _client = client
+        _client_gen += 1
+        _db_name = db_name
+    _bootstrapped = False
+    profile_cache.clear()
+    file_cache.clear()
+    archive_keys_cache.clear()
+
+def history_read_preference():
+    # History and search tolerate replication lag; writes and live reads stay on the primary
+    return _READ_PREFERENCES[os.getenv("MONGO_HISTORY_READ_PREFERENCE", "secondaryPreferred")]
+
+class _Lazy:
+    # Stands in for a collection/bucket and builds it on first attribute access
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+        self._gen = -1
+
+    def __getattr__(self, attr):
+        if self._obj is None or self._gen != _client_gen:
+            self._obj = self._factory()
+            self._gen = _client_gen
+        return getattr(self._obj, attr)
+
+def _collection(name):
+    return _Lazy(lambda: get_db()[name])
+
+def db_health():
+    try:
+        started = time.perf_counter()
+        get_client().admin.command("ping")
+        return {
+            "ok": True,
+            "ping_ms": round((time.perf_counter() - started) * 1000, 2),
+            "pool": dict(pool_stats.counts),
+            "options": client_options(),
+        }
+    except Exception as e:
+        logging.error(f"Database health check failed: {e}")
+        return {"ok": False, "error": str(e), "pool": dict(pool_stats.counts)}
 
 # Collections
-users_coll    = db["users"]
-messages_coll = db["messages"]
-groups_coll   = db["groups"]
-invites_coll  = db["invitations"]
-files_coll    = db["files"]
-notes_coll    = db["notifications"]
+users_coll    = _collection("users")
+messages_coll = _collection("messages")
+groups_coll   = _collection("groups")
+invites_coll  = _collection("invitations")
+files_coll    = _collection("files")
+notes_coll    = _collection("notifications")
+# One document per (user, conversation) pair, maintained on write so the
+# chat sidebar never has to scan message history
+conversations_coll = _collection("conversations")
+# Per-user unread total ({_id: username, unread_total}), kept in step with the
+# per-conversation unread_count fields above
+counters_coll = _collection("counters")
+# Resumable background jobs (account deletion), one document per job
+jobs_coll     = _collection("jobs")
+# Same collection, for history/search reads that may go to a secondary
+messages_read_coll = _Lazy(lambda: get_db()["messages"].with_options(read_preference=history_read_preference()))
+# Cold tier: messages older than ARCHIVE_AFTER_DAYS, moved by archive_messages
+# so the hot collection and its indexes stay small enough to live in memory
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+# Optional read copy of busy group rooms: up to BUCKET_SIZE consecutive
+# messages per document, so a history page is one or two document reads.
+# BUCKET_ROOMS is a comma-separated list of group names, or "*" for all groups.
+BUCKET_SIZE       = int(os.getenv("BUCKET_SIZE", "200"))
+BUCKET_ROOMS      = os.getenv("BUCKET_ROOMS", "")
+buckets_coll      = _collection("message_buckets")
+buckets_read_coll = _Lazy(lambda: get_db()["message_buckets"].with_options(read_preference=history_read_preference()))
+archive_coll      = _collection("messages_archive")
+archive_read_coll = _Lazy(lambda: get_db()["messages_archive"].with_options(read_preference=history_read_preference()))
 
-def init_db():
+# Attachments live in GridFS (attachments.files / attachments.chunks);
+# files_coll only holds legacy inline blobs until migrate_files_to_gridfs runs
+FILE_CHUNK_SIZE = 255 * 1024
+fs_bucket       = _Lazy(lambda: gridfs.GridFSBucket(get_db(), bucket_name="attachments", chunk_size_bytes=FILE_CHUNK_SIZE))
+fs_files_coll   = _collection("attachments.files")
+
+# Thumbnails and file metadata are immutable, so they are cached by file id
+# in a byte-bounded LRU shared across sessions
+THUMBNAIL_SIZE   = (320, 320)
+FILE_CACHE_BYTES = int(os.getenv("FILE_CACHE_BYTES", str(64 * 1024 * 1024)))
+file_cache       = LRUCache(maxsize=10000, maxweight=FILE_CACHE_BYTES,
+                            weigher=lambda v: len(v) if isinstance(v, bytes) else 256)
+
+# Process-wide profile cache shared by all sessions (username -> profile or None)
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "5000"))
+PROFILE_CACHE_TTL  = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+profile_cache      = LRUCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+
+# conversation_key -> whether it has archived messages (see _has_archive)
+ARCHIVE_KEYS_TTL   = float(os.getenv("ARCHIVE_KEYS_TTL", "600"))
+archive_keys_cache = LRUCache(maxsize=10000, ttl=ARCHIVE_KEYS_TTL)
+
+def _ensure_ttl_index(coll, field, seconds, partial):
+    # create_index refuses to change expireAfterSeconds; collMod can
+    name = f"{field}_ttl"
+    existing = coll.index_information().get(name)
+    if existing and existing.get("expireAfterSeconds") != seconds:
+        coll.database.command("collMod", coll.name, index={"name": name, "expireAfterSeconds": seconds})
+    elif not existing:
+        coll.create_index([(field, 1)], name=name, expireAfterSeconds=seconds, partialFilterExpression=partial)
+
+@instrumented
+def ensure_indexes():
+    # Schema/index migrations; idempotent, also run by `python manage.py migrate`
     try:
         users_coll.create_index("username", unique=True)
         groups_coll.create_index("name", unique=True)
         notes_coll.create_index([("user", 1), ("read", 1)])
-        messages_coll.create_index([("content", "text")])
+        notes_coll.create_index([("msg.sender", 1), ("_id", 1)])
+        _ensure_ttl_index(notes_coll, "read_at", NOTIFY_TTL_DAYS * 86400, {"read": True})
+        archive_coll.create_index([("conversation_key", 1), ("timestamp", 1), ("_id", 1)])
+        buckets_coll.create_index([("conversation_key", 1), ("end_ts", -1)])
+        buckets_coll.create_index([("conversation_key", 1), ("count", 1)])
+        buckets_coll.create_index([("messages._id", 1)])
+        buckets_coll.create_index([("messages.sender", 1)])
+        archive_coll.create_index([("sender", 1), ("_id", 1)])
+        archive_coll.create_index([("receiver", 1), ("_id", 1)])
+        if SEARCH_BACKEND == "mongo":
+            messages_coll.create_index([("content", "text")])
         messages_coll.create_index([("timestamp", 1)])
+        messages_coll.create_index([("conversation_key", 1), ("timestamp", 1), ("_id", 1)])
+        messages_coll.create_index([("conversation_key", 1), ("updated_at", 1)])
+        messages_coll.create_index([("updated_at", 1)])
+        messages_coll.create_index([("sender", 1), ("_id", 1)])
+        messages_coll.create_index([("receiver", 1), ("_id", 1)])
+        jobs_coll.create_index([("state", 1), ("lease_until", 1)])
+        if "user_1_partner_1" in conversations_coll.index_information():
+            conversations_coll.drop_index("user_1_partner_1")  # group rows have no partner
+        conversations_coll.create_index([("user", 1), ("conversation_key", 1)], unique=True)
+        conversations_coll.create_index([("user", 1), ("last_message_ts", -1)])
+    except Exception as e:
+        logging.error(f"Error creating indexes: {e}")
+        raise
 
+@instrumented
+def ensure_defaults():
+    try:
         admin_u = os.getenv("ADMIN_USERNAME")
         admin_p = os.getenv("ADMIN_PASSWORD")
-        if not users_coll.find_one({"username": admin_u}):
+        if not users_coll.find_one({"username": admin_u}, {"_id": 1}):
             users_coll.insert_one({
                 "username": admin_u,
                 "password_hash": bcrypt.hash(admin_p),
@@ -43,7 +259,7 @@ def init_db():
                 "created_at": datetime.utcnow()
             })
 
-        if not groups_coll.find_one({"name": "3D Chat"}):
+        if not groups_coll.find_one({"name": "3D Chat"}, {"_id": 1}):
             groups_coll.insert_one({
                 "name": "3D Chat",
                 "creator": admin_u,
@@ -51,11 +267,50 @@ def init_db():
                 "is_public": True,
                 "created_at": datetime.utcnow()
             })
+    except Exception as e:
+        logging.error(f"Error creating default admin and rooms: {e}")
+        raise
+
+@instrumented
+def init_db():
+    try:
+        ensure_indexes()
+        ensure_defaults()
     except Exception as e:
         logging.error(f"Error initializing database: {e}")
         raise
 
+# Process bootstrap: init_db runs once per process, not once per rerun
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+startup_timings = {}
+_bootstrapped   = False
+_bootstrap_lock = threading.Lock()
+
+def record_startup_timing(name, ms):
+    # First measurement wins; later reruns reuse cached imports and don't count
+    startup_timings.setdefault(name, round(ms, 2))
+
+@instrumented
+def ensure_db():
+    # Returns True only for the call that actually bootstrapped the process
+    global _bootstrapped
+    if _bootstrapped:
+        return False
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return False
+        started = time.perf_counter()
+        if DB_AUTO_MIGRATE:
+            init_db()
+        else:
+            ensure_defaults()
+        record_startup_timing("db_bootstrap_ms", (time.perf_counter() - started) * 1000)
+        resume_jobs()
+        _bootstrapped = True
+        return True
+
 # User management
+@instrumented
 def create_user(username, password, profile):
     try:
         pw = bcrypt.hash(password)
@@ -70,10 +325,12 @@ def create_user(username, password, profile):
             "settings": {"theme": "light", "background_color": "#f0f0f0"},
             "created_at": datetime.utcnow()
         })
+        profile_cache.invalidate(username)
     except Exception as e:
         logging.error(f"Error creating user {username}: {e}")
         raise
 
+@instrumented
 def get_user(username):
     try:
         return users_coll.find_one({"username": username})
@@ -81,6 +338,41 @@ def get_user(username):
         logging.error(f"Error fetching user {username}: {e}")
         raise
 
+@instrumented
+def get_users_by_names(usernames):
+    # Resolve many profiles at once: cache hits first, then a single $in query for the rest
+    try:
+        found, missing = {}, []
+        for name in set(usernames):
+            prof = profile_cache.get(name)
+            if prof is MISSING:
+                missing.append(name)
+            else:
+                found[name] = prof
+        if missing:
+            docs = users_coll.find({"username": {"$in": missing}}, {"username": 1, "profile": 1})
+            for doc in docs:
+                found[doc["username"]] = doc.get("profile", {})
+            for name in missing:
+                found.setdefault(name, None)
+                profile_cache.set(name, found[name])
+        return found
+    except Exception as e:
+        logging.error(f"Error fetching users {usernames}: {e}")
+        raise
+
+@instrumented
+def find_users(prefix, exclude=None, limit=20):
+    # Anchored prefix match so the username index is used
+    try:
+        query = {"username": {"$regex": "^" + re.escape(prefix)}}
+        if exclude:
+            query["username"]["$ne"] = exclude
+        return [d["username"] for d in users_coll.find(query, {"username": 1}).sort("username", 1).limit(limit)]
+    except Exception as e:
+        logging.error(f"Error searching users for {prefix}: {e}")
+        raise
+
 def check_password(h, p):
     try:
         return bcrypt.verify(p, h)
@@ -88,6 +380,7 @@ def check_password(h, p):
         logging.error(f"Error checking password: {e}")
         raise
 
+@instrumented
 def update_profile(username, profile, visible_fields):
     try:
         profile["display_name"] = profile.get("display_name", profile.get("name", username))
@@ -96,10 +389,12 @@ def update_profile(username, profile, visible_fields):
             {"username": username},
             {"$set": {"profile": profile, "visible_fields": visible_fields}}
         )
+        profile_cache.invalidate(username)
     except Exception as e:
         logging.error(f"Error updating profile for {username}: {e}")
         raise
 
+@instrumented
 def update_settings(username, settings):
     try:
         users_coll.update_one(
@@ -110,167 +405,1217 @@ def update_settings(username, settings):
         logging.error(f"Error updating settings for {username}: {e}")
         raise
 
-def delete_user(username):
+@instrumented
+def delete_user(username, wait=False):
+    # Starts (or joins) a background deletion job; returns its id, or False for
+    # admins and unknown users.  The account is locked at once; its data is
+    # removed in batches by run_job.  wait=True runs the job on this thread.
     try:
-        # Prevent admin deletion
-        user = users_coll.find_one({"username": username})
-        if user.get("is_admin", False):
+        user = users_coll.find_one_and_update(
+            {"username": username, "is_admin": {"$ne": True}},
+            {"$set": {"deleting": True}},
+            projection={"_id": 1}
+        )
+        if user is None:
             return False
-        # Delete user data
-        users_coll.delete_one({"username": username})
-        messages_coll.delete_many({"$or": [{"sender": username}, {"receiver": username}]})
-        groups_coll.update_many({"members": username}, {"$pull": {"members": username}})
-        groups_coll.delete_many({"creator": username})
-        invites_coll.delete_many({"$or": [{"invited_user": username}, {"group": {"$in": groups_coll.distinct("name", {"creator": username})}}]})
-        notes_coll.delete_many({"user": username})
-        files_coll.delete_many({"_id": {"$in": messages_coll.distinct("file_id", {"sender": username})}})
-        return True
+        profile_cache.invalidate(username)
+        job = jobs_coll.find_one_and_update(
+            {"type": "delete_user", "target": username, "state": {"$in": ["pending", "running"]}},
+            {"$setOnInsert": {
+                "type": "delete_user", "target": username, "state": "pending",
+                "step": DELETE_USER_STEPS[0], "cursor": None, "progress": {},
+                "lease_until": None, "created_at": datetime.utcnow()
+            }},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        if wait:
+            run_job(job["_id"])
+        else:
+            enqueue_job(job["_id"])
+        return str(job["_id"])
     except Exception as e:
         logging.error(f"Error deleting user {username}: {e}")
         raise
 
 # File storage
+def _file_mime(name):
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+def make_thumbnail(data):
+    # JPEG thumbnail bytes for an image, or None if it can't be decoded
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.thumbnail(THUMBNAIL_SIZE)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=80)
+        return out.getvalue()
+    except Exception as e:
+        logging.error(f"Error generating thumbnail: {e}")
+        return None
+
+@instrumented
 def store_file(buf: io.BytesIO, name: str) -> str:
     try:
-        res = files_coll.insert_one({"name": name, "content": buf.getvalue(), "ts": datetime.utcnow()})
-        return str(res.inserted_id)
+        mime = _file_mime(name)
+        fid = ObjectId()
+        metadata = {"mime": mime}
+        if mime.startswith("image/"):
+            thumb = make_thumbnail(buf.getvalue())
+            if thumb:
+                metadata["thumb_id"] = fs_bucket.upload_from_stream(
+                    f"thumb_{name}.jpg", io.BytesIO(thumb),
+                    metadata={"mime": "image/jpeg", "thumb_of": fid}
+                )
+        buf.seek(0)
+        fs_bucket.upload_from_stream_with_id(fid, name, buf, metadata=metadata)
+        return str(fid)
     except Exception as e:
         logging.error(f"Error storing file {name}: {e}")
         raise
 
+@instrumented
+def get_file_meta(file_id):
+    # Name, size and mime only -- never touches the file content
+    try:
+        meta = file_cache.get(("meta", str(file_id)))
+        if meta is not MISSING:
+            return meta
+        oid = ObjectId(file_id)
+        doc = fs_files_coll.find_one({"_id": oid}, {"filename": 1, "length": 1, "metadata": 1})
+        if doc:
+            extra = doc.get("metadata") or {}
+            meta = {"_id": oid, "name": doc["filename"], "size": doc["length"],
+                    "mime": extra.get("mime") or _file_mime(doc["filename"]), "thumb_id": extra.get("thumb_id")}
+        else:
+            legacy = list(files_coll.aggregate([
+                {"$match": {"_id": oid}},
+                {"$project": {"name": 1, "size": {"$binarySize": "$content"}}}
+            ]))
+            if not legacy:
+                return None
+            meta = {"_id": oid, "name": legacy[0]["name"], "size": legacy[0]["size"],
+                    "mime": _file_mime(legacy[0]["name"]), "thumb_id": None}
+        file_cache.set(("meta", str(file_id)), meta)
+        return meta
+    except Exception as e:
+        logging.error(f"Error fetching file metadata {file_id}: {e}")
+        raise
+
+@instrumented
+def get_thumbnail(file_id):
+    # Thumbnail bytes for an image attachment, or None if it has none
+    try:
+        data = file_cache.get(("thumb", str(file_id)))
+        if data is not MISSING:
+            return data
+        meta = get_file_meta(file_id)
+        data = None
+        if meta and meta.get("thumb_id"):
+            data = b"".join(iter_file_chunks(meta["thumb_id"]))
+        file_cache.set(("thumb", str(file_id)), data)
+        return data
+    except Exception as e:
+        logging.error(f"Error fetching thumbnail {file_id}: {e}")
+        raise
+
+@instrumented
+def iter_file_chunks(file_id):
+    # Streams the content chunk by chunk
+    try:
+        oid = ObjectId(file_id)
+        try:
+            stream = fs_bucket.open_download_stream(oid)
+        except NoFile:
+            legacy = files_coll.find_one({"_id": oid}, {"content": 1})
+            if legacy:
+                yield legacy["content"]
+            return
+        with stream:
+            while True:
+                chunk = stream.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+    except Exception as e:
+        logging.error(f"Error streaming file {file_id}: {e}")
+        raise
+
+@instrumented
 def get_file(file_id: str):
     try:
-        return files_coll.find_one({"_id": ObjectId(file_id)})
+        meta = get_file_meta(file_id)
+        if meta is None:
+            return None
+        # A copy: meta is the cached dict, which must stay content-free
+        return dict(meta, content=b"".join(iter_file_chunks(file_id)))
     except Exception as e:
         logging.error(f"Error fetching file {file_id}: {e}")
         raise
 
+@instrumented
+def delete_files(file_ids):
+    try:
+        oids = [ObjectId(f) for f in file_ids if f]
+        oids += [d["_id"] for d in fs_files_coll.find({"metadata.thumb_of": {"$in": oids}}, {"_id": 1})]
+        for oid in oids:
+            file_cache.invalidate(("meta", str(oid)))
+            file_cache.invalidate(("thumb", str(oid)))
+            try:
+                fs_bucket.delete(oid)
+            except NoFile:
+                pass
+        if oids:
+            files_coll.delete_many({"_id": {"$in": oids}})
+    except Exception as e:
+        logging.error(f"Error deleting files: {e}")
+        raise
+
+# Notification fan-out
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "500"))
+NOTIFY_TTL_DAYS   = int(os.getenv("NOTIFY_TTL_DAYS", "30"))   # read notifications expire after this
+NOTIFY_ASYNC      = os.getenv("NOTIFY_ASYNC", "true").lower() in ("1", "true", "yes")
+SNIPPET_LENGTH    = 120
+_fanout_queue     = queue.Queue()
+_fanout_worker    = None
+_fanout_lock      = threading.Lock()
+
+def message_ref(doc):
+    # What a notification stores instead of a full copy of the message
+    ref = {
+        "_id": doc["_id"],
+        "sender": doc["sender"],
+        "content": doc.get("content", "")[:SNIPPET_LENGTH],
+        "has_file": bool(doc.get("file_id")),
+    }
+    if doc.get("receiver"):
+        ref["receiver"] = doc["receiver"]
+    if doc.get("group"):
+        ref["group"] = doc["group"]
+    return ref
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+@instrumented
+def fan_out_many(items):
+    # items: [(message doc, recipients)].  Notifications for all messages are
+    # written in insert_many chunks; unread counters and group conversation
+    # rows are aggregated per user first, so each user gets one update per call
+    try:
+        notes, unread, rows = [], Counter(), {}
+        for doc, recipients in items:
+            ref = message_ref(doc)
+            for u in recipients:
+                notes.append({"user": u, "msg": ref, "read": False, "ts": doc["timestamp"]})
+                unread[u] += 1
+                if doc.get("group"):
+                    row = rows.setdefault((u, doc["conversation_key"]), {"n": 0})
+                    row["n"] += 1
+                    row["fields"] = {
+                        "group": doc["group"],
+                        "last_message_ts": doc["timestamp"],
+                        "last_snippet": doc.get("content", "")[:SNIPPET_LENGTH],
+                    }
+        for chunk in _chunks(notes, NOTIFY_BATCH_SIZE):
+            notes_coll.insert_many(chunk, ordered=False)
+        counter_ops = [UpdateOne({"_id": u}, {"$inc": {"unread_total": n}}, upsert=True) for u, n in unread.items()]
+        for chunk in _chunks(counter_ops, NOTIFY_BATCH_SIZE):
+            counters_coll.bulk_write(chunk, ordered=False)
+        row_ops = [
+            UpdateOne({"user": u, "conversation_key": key},
+                      {"$set": row["fields"], "$inc": {"unread_count": row["n"]}}, upsert=True)
+            for (u, key), row in rows.items()
+        ]
+        for chunk in _chunks(row_ops, NOTIFY_BATCH_SIZE):
+            conversations_coll.bulk_write(chunk, ordered=False)
+    except Exception as e:
+        logging.error(f"Error fanning out notifications for {len(items)} messages: {e}")
+        raise
+
+def _fanout_loop():
+    while True:
+        items = _fanout_queue.get()
+        try:
+            fan_out_many(items)
+        except Exception:
+            pass  # already logged; one failed fan-out must not stop the worker
+        finally:
+            _fanout_queue.task_done()
+
+def _ensure_fanout_worker():
+    global _fanout_worker
+    with _fanout_lock:
+        if _fanout_worker is None or not _fanout_worker.is_alive():
+            _fanout_worker = threading.Thread(target=_fanout_loop, name="notify-fanout", daemon=True)
+            _fanout_worker.start()
+
+def enqueue_fanout(items):
+    # Large fan-outs run on a background worker so the sender's rerun is not blocked
+    if NOTIFY_ASYNC and sum(len(r) for _, r in items) > 1:
+        _ensure_fanout_worker()
+        _fanout_queue.put(items)
+    else:
+        fan_out_many(items)
+
+def enqueue_notifications(doc, recipients):
+    enqueue_fanout([(doc, list(recipients))])
+
+def flush_notifications(timeout=None):
+    # Wait for queued fan-outs (used by scripts and tests of the send path)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while _fanout_queue.unfinished_tasks:
+        if deadline is not None and time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+# Background jobs
+# A job walks its steps in order; each step works in JOB_BATCH_SIZE batches
+# keyed by _id and checkpoints (step, cursor, progress) after every batch, so a
+# restarted process resumes where it stopped.  A lease keeps two processes from
+# running the same job.
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "500"))
+JOB_LEASE      = timedelta(seconds=60)
+_job_queue     = queue.Queue()
+_job_worker    = None
+_job_lock      = threading.Lock()
+
+# Order matters: attachments are found through the user's messages, and
+# invites through the groups the user created, so both go before their sources
+DELETE_USER_STEPS = (
+    "files", "archived_files", "messages_sent", "messages_received",
+    "archived_sent", "archived_received", "buckets", "invites_received",
+    "group_invites", "memberships", "groups", "notifications", "notifications_sent",
+    "conversations", "account",
+)
+
+def _batch_ids(coll, query, after, projection=None):
+    if after is not None:
+        query = dict(query, _id={"$gt": after})
+    return list(coll.find(query, projection or {"_id": 1}).sort("_id", 1).limit(JOB_BATCH_SIZE))
+
+def _delete_by_ids(coll, docs):
+    if docs:
+        coll.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+
+def _delete_user_batch(username, step, after):
+    # Runs one bounded batch of a step; returns (cursor, docs handled), with
+    # cursor None once the step is finished
+    if step == "account":
+        counters_coll.delete_one({"_id": username})
+        users_coll.delete_one({"username": username})
+        profile_cache.invalidate(username)
+        return None, 1
+    if step in ("files", "archived_files"):
+        coll = messages_coll if step == "files" else archive_coll
+        docs = _batch_ids(coll, {"sender": username, "file_id": {"$ne": None}}, after, {"file_id": 1})
+        delete_files([d["file_id"] for d in docs])
+    elif step in ("messages_sent", "messages_received", "archived_sent", "archived_received"):
+        coll = messages_coll if step.startswith("messages") else archive_coll
+        field = "sender" if step.endswith("sent") else "receiver"
+        docs = _batch_ids(coll, {field: username}, after)
+        _delete_by_ids(coll, docs)
+    elif step == "buckets":
+        docs = _batch_ids(buckets_coll, {"messages.sender": username}, after)
+        if docs:
+            buckets_coll.update_many({"_id": {"$in": [d["_id"] for d in docs]}},
+                                     {"$pull": {"messages": {"sender": username}}})
+    elif step == "invites_received":
+        docs = _batch_ids(invites_coll, {"invited_user": username}, after)
+        _delete_by_ids(invites_coll, docs)
+    elif step == "group_invites":
+        docs = _batch_ids(groups_coll, {"creator": username}, after, {"name": 1})
+        if docs:
+            invites_coll.delete_many({"group": {"$in": [d["name"] for d in docs]}})
+    elif step == "memberships":
+        docs = _batch_ids(groups_coll, {"members": username}, after)
+        if docs:
+            groups_coll.update_many({"_id": {"$in": [d["_id"] for d in docs]}}, {"$pull": {"members": username}})
+    elif step == "groups":
+        docs = _batch_ids(groups_coll, {"creator": username}, after)
+        _delete_by_ids(groups_coll, docs)
+    elif step == "notifications":
+        docs = _batch_ids(notes_coll, {"user": username}, after)
+        _delete_by_ids(notes_coll, docs)
+    elif step == "notifications_sent":
+        # Other users' notifications about this user's messages.  Unread group
+        # ones are taken off the recipient's group row and total here; private
+        # ones are covered by the partner's row in the "conversations" step.
+        # Notifications are deleted first, so a re-run batch never subtracts twice.
+        docs = _batch_ids(notes_coll, {"msg.sender": username}, after, {"user": 1, "read": 1, "msg.group": 1})
+        _delete_by_ids(notes_coll, docs)
+        unread = Counter((d["user"], d["msg"]["group"]) for d in docs if not d.get("read") and d["msg"].get("group"))
+        totals = Counter()
+        for (user, group), n in unread.items():
+            conversations_coll.update_one({"user": user, "conversation_key": conversation_key(group=group)}, [{"$set": {
+                "unread_count": {"$max": [0, {"$subtract": [{"$ifNull": ["$unread_count", 0]}, n]}]}
+            }}])
+            totals[user] += n
+        for user, n in totals.items():
+            counters_coll.update_one({"_id": user}, [{"$set": {"unread_total": {
+                "$max": [0, {"$subtract": [{"$ifNull": ["$unread_total", 0]}, n]}]
+            }}}])
+    elif step == "conversations":
+        docs = _batch_ids(conversations_coll, {"$or": [{"user": username}, {"partner": username}]}, after,
+                          {"user": 1, "unread_count": 1})
+        # Partners' rows may hold unread messages from this user; take them
+        # off the partner's total like _reset_unread does.  A row's count is
+        # subtracted only by whoever removed it, so re-running a batch after
+        # an interruption never subtracts twice.
+        for d in docs:
+            if d["user"] != username and d.get("unread_count"):
+                before = conversations_coll.find_one_and_delete({"_id": d["_id"]}, projection={"unread_count": 1})
+                if before and before.get("unread_count"):
+                    counters_coll.update_one({"_id": d["user"]}, [{"$set": {"unread_total": {
+                        "$max": [0, {"$subtract": [{"$ifNull": ["$unread_total", 0]}, before["unread_count"]]}]
+                    }}}])
+        _delete_by_ids(conversations_coll, docs)
+    else:
+        raise ValueError(f"Unknown delete_user step: {step}")
+    cursor = docs[-1]["_id"] if len(docs) == JOB_BATCH_SIZE else None
+    return cursor, len(docs)
+
+def _claim_job(job_id):
+    now = datetime.utcnow()
+    return jobs_coll.find_one_and_update(
+        {"_id": job_id, "state": {"$in": ["pending", "running"]},
+         "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]},
+        {"$set": {"state": "running", "lease_until": now + JOB_LEASE, "updated_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+
+@instrumented
+def run_job(job_id):
+    # Runs a job to completion on the calling thread; returns its final state,
+    # or None if another process holds it
+    job = _claim_job(ObjectId(job_id))
+    if job is None:
+        return None
+    step, cursor = job["step"], job.get("cursor")
+    try:
+        while step is not None:
+            cursor, n = _delete_user_batch(job["target"], step, cursor)
+            update = {"$inc": {f"progress.{step}": n}}
+            if cursor is None:
+                i = DELETE_USER_STEPS.index(step) + 1
+                step = DELETE_USER_STEPS[i] if i < len(DELETE_USER_STEPS) else None
+            now = datetime.utcnow()
+            update["$set"] = {"step": step, "cursor": cursor, "lease_until": now + JOB_LEASE, "updated_at": now}
+            if step is None:
+                update["$set"].update(state="done", finished_at=now, lease_until=None)
+            jobs_coll.update_one({"_id": job["_id"]}, update)
+        return "done"
+    except Exception as e:
+        logging.error(f"Job {job_id} failed at step {step}: {e}")
+        jobs_coll.update_one({"_id": job["_id"]}, {"$set": {
+            "state": "failed", "error": str(e), "lease_until": None, "updated_at": datetime.utcnow()
+        }})
+        return "failed"
+
+def _job_loop():
+    while True:
+        job_id = _job_queue.get()
+        try:
+            run_job(job_id)
+        except Exception as e:
+            logging.error(f"Job worker error for {job_id}: {e}")
+        finally:
+            _job_queue.task_done()
+
+def enqueue_job(job_id):
+    global _job_worker
+    with _job_lock:
+        if _job_worker is None or not _job_worker.is_alive():
+            _job_worker = threading.Thread(target=_job_loop, name="jobs", daemon=True)
+            _job_worker.start()
+    _job_queue.put(job_id)
+
+@instrumented
+def resume_jobs():
+    # Re-queues unfinished jobs whose lease has lapsed (e.g. after a restart)
+    try:
+        ids = [j["_id"] for j in jobs_coll.find(
+            {"state": {"$in": ["pending", "running"]},
+             "$or": [{"lease_until": None}, {"lease_until": {"$lt": datetime.utcnow()}}]},
+            {"_id": 1}
+        )]
+        for job_id in ids:
+            enqueue_job(job_id)
+        return len(ids)
+    except Exception as e:
+        logging.error(f"Error resuming jobs: {e}")
+        raise
+
+@instrumented
+def retry_job(job_id, wait=False):
+    # Puts a failed job back in the queue; it resumes from its checkpoint
+    try:
+        res = jobs_coll.update_one(
+            {"_id": ObjectId(job_id), "state": "failed"},
+            {"$set": {"state": "pending", "updated_at": datetime.utcnow()}, "$unset": {"error": ""}}
+        )
+        if res.modified_count:
+            if wait:
+                return run_job(job_id)
+            enqueue_job(ObjectId(job_id))
+        return bool(res.modified_count)
+    except Exception as e:
+        logging.error(f"Error retrying job {job_id}: {e}")
+        raise
+
+def job_fraction(job):
+    # Share of steps completed, for progress bars
+    if job["state"] == "done":
+        return 1.0
+    return DELETE_USER_STEPS.index(job["step"]) / len(DELETE_USER_STEPS)
+
+@instrumented
+def get_job(job_id):
+    try:
+        return jobs_coll.find_one({"_id": ObjectId(job_id)})
+    except Exception as e:
+        logging.error(f"Error fetching job {job_id}: {e}")
+        raise
+
+@instrumented
+def list_jobs(limit=20):
+    try:
+        return list(jobs_coll.find().sort("_id", -1).limit(limit))
+    except Exception as e:
+        logging.error(f"Error listing jobs: {e}")
+        raise
+
 # Messaging
+def _key_part(name):
+    # "|" separates the pair, so it is escaped inside names (as is the escape
+    # character itself); otherwise ("a|b", "c") and ("a", "b|c") would collide
+    return name.replace("\\", "\\\\").replace("|", "\\|")
+
+def conversation_key(u1=None, u2=None, group=None):
+    # Canonical id of a conversation: the group name, or the sorted user pair
+    if group:
+        return f"g:{group}"
+    a, b = sorted([u1, u2])
+    return f"p:{_key_part(a)}|{_key_part(b)}"
+
+def message_conversation_key(doc):
+    if doc.get("conversation_key"):
+        return doc["conversation_key"]
+    if doc.get("group"):
+        return conversation_key(group=doc["group"])
+    return conversation_key(doc["sender"], doc.get("receiver"))
+
+@instrumented
 def create_message(sender, receiver=None, group=None, content="", file_id=None):
     try:
+        now = datetime.utcnow()
         doc = {
             "sender": sender,
             "content": content,
-            "timestamp": datetime.utcnow(),
+            "timestamp": now,
+            "updated_at": now,
             "file_id": file_id,
             "read": False,
             "reactions": {}
         }
+        recipients = []
         if receiver:
             doc["receiver"] = receiver
-            notes_coll.insert_one({"user": receiver, "msg": doc, "read": False, "ts": doc["timestamp"]})
+            recipients.append(receiver)
         if group:
             doc["group"] = group
-            group_doc = groups_coll.find_one({"name": group})
+            group_doc = groups_coll.find_one({"name": group}, {"members": 1})
             if group_doc:
-                for member in group_doc["members"]:
-                    if member != sender:
-                        notes_coll.insert_one({"user": member, "msg": doc, "read": False, "ts": doc["timestamp"]})
+                recipients.extend(m for m in group_doc["members"] if m != sender)
             else:
                 logging.error(f"Group {group} not found")
                 raise ValueError(f"Group {group} not found")
+        doc["conversation_key"] = message_conversation_key(doc)
         res = messages_coll.insert_one(doc)
+        if bucketed(doc["conversation_key"]):
+            _bucket_append(doc)
+        if receiver:
+            touch_conversation(doc)
+        if recipients:
+            enqueue_notifications(doc, recipients)
         return str(res.inserted_id)
     except Exception as e:
         logging.error(f"Error creating message from {sender} to {receiver or group}: {e}")
         raise
 
-def get_private_conversation(u1, u2, skip=0, limit=50):
+@instrumented
+def create_messages_bulk(messages, batch_size=1000):
+    # messages: dicts with sender, receiver or group, content and optional
+    # file_id/timestamp, possibly across many conversations.  Group membership
+    # is resolved once per group; messages go in with ordered insert_many and
+    # conversation rows/notifications with bulk writes.  Returns ids in order.
     try:
-        return list(messages_coll.find(
-            {"$or": [{"sender": u1, "receiver": u2}, {"sender": u2, "receiver": u1}]}
-        ).sort("timestamp", -1).skip(skip).limit(limit))[::-1]
+        messages = list(messages)
+        names = list({m["group"] for m in messages if m.get("group")})
+        members = {g["name"]: g["members"] for g in groups_coll.find({"name": {"$in": names}}, {"name": 1, "members": 1})}
+        missing = set(names) - set(members)
+        if missing:
+            raise ValueError(f"Groups not found: {', '.join(sorted(missing))}")
+
+        now = datetime.utcnow()
+        docs, items, conv_ops = [], [], []
+        for m in messages:
+            doc = {
+                "_id": ObjectId(),
+                "sender": m["sender"],
+                "content": m.get("content", ""),
+                "timestamp": m.get("timestamp") or now,
+                "updated_at": now,
+                "file_id": m.get("file_id"),
+                "read": False,
+                "reactions": {}
+            }
+            if m.get("receiver"):
+                doc["receiver"] = m["receiver"]
+                items.append((doc, [m["receiver"]]))
+            elif m.get("group"):
+                doc["group"] = m["group"]
+                items.append((doc, [u for u in members[m["group"]] if u != m["sender"]]))
+            else:
+                raise ValueError(f"Message from {m['sender']} has neither receiver nor group")
+            doc["conversation_key"] = message_conversation_key(doc)
+            if doc.get("receiver"):
+                conv_ops.extend(_conversation_updates(doc))
+            docs.append(doc)
+
+        for chunk in _chunks(docs, batch_size):
+            messages_coll.insert_many(chunk, ordered=True)
+        by_room = {}
+        for doc in docs:
+            if bucketed(doc["conversation_key"]):
+                by_room.setdefault(doc["conversation_key"], []).append(doc)
+        for key, room_docs in by_room.items():
+            _bucket_append_many(key, room_docs)
+        for chunk in _chunks(conv_ops, batch_size):
+            conversations_coll.bulk_write(chunk, ordered=True)  # keeps last_message_ts in send order
+        if items:
+            enqueue_fanout(items)
+        return [str(d["_id"]) for d in docs]
     except Exception as e:
-        logging.error(f"Error fetching private conversation between {u1} and {u2}: {e}")
+        logging.error(f"Error creating {len(messages)} messages in bulk: {e}")
+        raise
+
+# History pagination: pages are anchored on the (timestamp, _id) of the oldest
+# message already loaded, so inserts while scrolling never shift the window
+_EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(doc):
+    ms = (doc["timestamp"] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{ms}:{doc['_id']}"
+
+def decode_cursor(cursor):
+    ms, oid = cursor.split(":", 1)
+    return _EPOCH + timedelta(milliseconds=int(ms)), ObjectId(oid)
+
+def _older_than(query, ts, oid):
+    return {"$and": [query, {"$or": [
+        {"timestamp": {"$lt": ts}},
+        {"timestamp": ts, "_id": {"$lt": oid}}
+    ]}]}
+
+def _has_archive(key):
+    # Whether any of the conversation's messages were archived, cached per
+    # process so short pages do not each pay an archive query.  archive runs
+    # from manage.py, so a new archive shows up here within ARCHIVE_KEYS_TTL.
+    found = archive_keys_cache.get(key)
+    if found is MISSING:
+        found = archive_read_coll.find_one({"conversation_key": key}, {"_id": 1}) is not None
+        archive_keys_cache.set(key, found)
+    return found
+
+def _history_page(key, cursor, limit):
+    # Newest-first walk over the hot collection that carries on into the
+    # archive once the hot tier runs out, so cursors work across both.
+    # Archived messages come back with archived=True (they are read-only).
+    # The first page comes from the primary: sessions and room fills take the
+    # live cursor before loading it, so it must see every earlier write.
+    base = {"conversation_key": key, "deleted": {"$ne": True}}
+    query = _older_than(base, *decode_cursor(cursor)) if cursor else base
+    order = [("timestamp", -1), ("_id", -1)]
+    coll = messages_read_coll if cursor else messages_coll
+    docs = list(coll.find(query).sort(order).limit(limit + 1))
+    if len(docs) <= limit and _has_archive(key):
+        if docs:
+            query = _older_than(base, docs[-1]["timestamp"], docs[-1]["_id"])
+        for d in archive_read_coll.find(query).sort(order).limit(limit + 1 - len(docs)):
+            d["archived"] = True
+            docs.append(d)
+    more = len(docs) > limit
+    docs = docs[:limit][::-1]
+    return docs, (encode_cursor(docs[0]) if more else None)
+
+# Message buckets
+_BUCKET_FIELDS = ("_id", "sender", "content", "timestamp", "updated_at", "file_id",
+                  "read", "edited", "edited_at", "reactions", "reactors")
+
+def bucketed(key):
+    if not BUCKET_ROOMS or not key.startswith("g:"):
+        return False
+    return BUCKET_ROOMS.strip() == "*" or key[2:] in {r.strip() for r in BUCKET_ROOMS.split(",")}
+
+def _bucket_entry(doc):
+    return {f: doc[f] for f in _BUCKET_FIELDS if f in doc}
+
+def _bucket_append(doc):
+    # Appends to the conversation's open bucket, or starts a new one when all
+    # are full.  count only grows (deletes pull entries without decrementing
+    # it), so a closed bucket is never reopened.
+    ts = doc["timestamp"]
+    buckets_coll.update_one(
+        {"conversation_key": doc["conversation_key"], "count": {"$lt": BUCKET_SIZE}},
+        {"$push": {"messages": _bucket_entry(doc)}, "$inc": {"count": 1},
+         "$min": {"start_ts": ts}, "$max": {"end_ts": ts}},
+        upsert=True
+    )
+
+def _bucket_append_many(key, docs):
+    # Bulk form of _bucket_append for one conversation: a single $push $each
+    # tops up the open bucket, and one insert_many adds new buckets for the
+    # rest, BUCKET_SIZE entries each
+    entries = [_bucket_entry(d) for d in docs]
+    open_bucket = buckets_coll.find_one({"conversation_key": key, "count": {"$lt": BUCKET_SIZE}}, {"count": 1})
+    if open_bucket:
+        head = entries[:BUCKET_SIZE - open_bucket["count"]]
+        ts = [e["timestamp"] for e in head]
+        # Guarded on count in case a concurrent append filled it meanwhile
+        if buckets_coll.update_one(
+            {"_id": open_bucket["_id"], "count": {"$lte": BUCKET_SIZE - len(head)}},
+            {"$push": {"messages": {"$each": head}}, "$inc": {"count": len(head)},
+             "$min": {"start_ts": min(ts)}, "$max": {"end_ts": max(ts)}}
+        ).modified_count:
+            entries = entries[len(head):]
+    if entries:
+        buckets_coll.insert_many([
+            {"conversation_key": key, "count": len(chunk), "messages": chunk,
+             "start_ts": min(e["timestamp"] for e in chunk), "end_ts": max(e["timestamp"] for e in chunk)}
+            for chunk in _chunks(entries, BUCKET_SIZE)
+        ], ordered=True)
+
+def _bucket_sync(doc, fields=None):
+    # Mirrors an edit, reaction or delete into the message's bucket entry
+    if not bucketed(doc.get("conversation_key") or ""):
+        return
+    if doc.get("deleted"):
+        buckets_coll.update_one({"messages._id": doc["_id"]}, {"$pull": {"messages": {"_id": doc["_id"]}}})
+        return
+    entry = _bucket_entry(doc)
+    update = {f"messages.$[m].{f}": entry[f] for f in (fields or entry) if f in entry and f != "_id"}
+    buckets_coll.update_one({"messages._id": doc["_id"]}, {"$set": update}, array_filters=[{"m._id": doc["_id"]}])
+
+def _bucket_page(key, cursor, limit):
+    # Same contract as _history_page, read from whole buckets newest-first.
+    # Buckets can overlap in time (concurrent first appends), so reading stops
+    # only once the next bucket ends before everything already on the page.
+    before = decode_cursor(cursor) if cursor else None
+    query = {"conversation_key": key}
+    if before:
+        query["start_ts"] = {"$lte": before[0]}
+    found = []
+    coll = buckets_read_coll if cursor else buckets_coll  # first page from the primary, as in _history_page
+    for bucket in coll.find(query, {"messages": 1, "end_ts": 1}).sort("end_ts", -1).batch_size(2):
+        if len(found) > limit and bucket["end_ts"] < found[limit]["timestamp"]:
+            break
+        found += [m for m in bucket["messages"] if before is None or (m["timestamp"], m["_id"]) < before]
+        found.sort(key=lambda m: (m["timestamp"], m["_id"]), reverse=True)
+    for m in found:
+        m["conversation_key"], m["group"] = key, key[2:]
+    if len(found) > limit:
+        page = found[:limit]
+        return page[::-1], encode_cursor(page[-1])
+    # Buckets exhausted: anything older is in the per-message tiers
+    after = encode_cursor(found[-1]) if found else cursor
+    rest, next_cursor = _history_page(key, after, max(1, limit - len(found)))
+    if len(found) == limit:
+        return found[::-1], (after if rest else None)
+    return rest + found[::-1], next_cursor
+
+@instrumented
+def rebuild_buckets(group_name, batch_size=BUCKET_SIZE):
+    # Rebuilds a room's buckets from its message history (e.g. after adding
+    # it to BUCKET_ROOMS); returns the number of buckets written
+    try:
+        key = conversation_key(group=group_name)
+        buckets_coll.delete_many({"conversation_key": key})
+        written, batch = 0, []
+        for doc in messages_coll.find({"conversation_key": key, "deleted": {"$ne": True}}).sort([("timestamp", 1), ("_id", 1)]):
+            batch.append(_bucket_entry(doc))
+            if len(batch) == batch_size:
+                buckets_coll.insert_one({"conversation_key": key, "count": len(batch), "messages": batch,
+                                         "start_ts": batch[0]["timestamp"], "end_ts": batch[-1]["timestamp"]})
+                written, batch = written + 1, []
+        if batch:
+            buckets_coll.insert_one({"conversation_key": key, "count": len(batch), "messages": batch,
+                                     "start_ts": batch[0]["timestamp"], "end_ts": batch[-1]["timestamp"]})
+            written += 1
+        return written
+    except Exception as e:
+        logging.error(f"Error rebuilding buckets for {group_name}: {e}")
         raise
 
-def get_group_conversation(group_name, skip=0, limit=50):
+# Conversation list
+def _conversation_updates(doc):
+    sender, receiver = doc["sender"], doc["receiver"]
+    fields = {
+        "conversation_key": doc["conversation_key"],
+        "last_message_ts": doc["timestamp"],
+        "last_snippet": doc.get("content", "")[:SNIPPET_LENGTH],
+    }
+    return [
+        UpdateOne({"user": sender, "conversation_key": fields["conversation_key"]},
+                  {"$set": dict(fields, partner=receiver), "$setOnInsert": {"unread_count": 0}}, upsert=True),
+        UpdateOne({"user": receiver, "conversation_key": fields["conversation_key"]},
+                  {"$set": dict(fields, partner=sender), "$inc": {"unread_count": 1}}, upsert=True),
+    ]
+
+@instrumented
+def touch_conversation(doc):
     try:
-        return list(messages_coll.find({"group": group_name}).sort("timestamp", -1).skip(skip).limit(limit))[::-1]
+        conversations_coll.bulk_write(_conversation_updates(doc), ordered=False)
     except Exception as e:
-        logging.error(f"Error fetching group conversation for {group_name}: {e}")
+        logging.error(f"Error updating conversation list for message {doc.get('_id')}: {e}")
         raise
 
-def get_new_private_messages(u1, u2, last_timestamp):
+@instrumented
+def list_conversations(username, limit=100):
     try:
-        return list(messages_coll.find({
-            "$or": [{"sender": u1, "receiver": u2}, {"sender": u2, "receiver": u1}],
-            "timestamp": {"$gt": last_timestamp}
-        }).sort("timestamp", 1))
+        return list(conversations_coll.find(
+            {"user": username, "partner": {"$exists": True}}
+        ).sort("last_message_ts", -1).limit(limit))
+    except Exception as e:
+        logging.error(f"Error listing conversations for {username}: {e}")
+        raise
+
+@instrumented
+def get_private_conversation(u1, u2, cursor=None, limit=50):
+    # Returns (messages oldest-first, cursor for the next older page or None)
+    try:
+        return _history_page(conversation_key(u1, u2), cursor, limit)
     except Exception as e:
-        logging.error(f"Error fetching new private messages between {u1} and {u2}: {e}")
+        logging.error(f"Error fetching private conversation between {u1} and {u2}: {e}")
+        raise
+
+@instrumented
+def get_group_conversation(group_name, cursor=None, limit=50):
+    try:
+        key = conversation_key(group=group_name)
+        if bucketed(key):
+            return _bucket_page(key, cursor, limit)
+        return _history_page(key, cursor, limit)
+    except Exception as e:
+        logging.error(f"Error fetching group conversation for {group_name}: {e}")
         raise
 
-def get_new_group_messages(group_name, last_timestamp):
+# Versioning: every write to a message bumps updated_at, and deletes leave a
+# tombstone, so one query on (conversation_key, updated_at) returns inserts,
+# edits, reactions and deletions since a watermark
+SYNC_OVERLAP = timedelta(seconds=float(os.getenv("SYNC_OVERLAP_SECONDS", "2")))
+SYNC_BATCH   = 500  # a full batch means more changes may follow
+
+@instrumented
+def get_conversation_changes(key, since, limit=SYNC_BATCH):
+    # Re-reads a small overlap before the watermark to tolerate clock skew
+    # between app servers; applying a change twice is harmless
     try:
         return list(messages_coll.find({
-            "group": group_name,
-            "timestamp": {"$gt": last_timestamp}
-        }).sort("timestamp", 1))
+            "conversation_key": key,
+            "updated_at": {"$gt": since - SYNC_OVERLAP}
+        }).sort("updated_at", 1).limit(limit))
     except Exception as e:
-        logging.error(f"Error fetching new group messages for {group_name}: {e}")
+        logging.error(f"Error fetching changes for {key}: {e}")
         raise
 
+@instrumented
 def delete_message(message_id, sender):
+    # Leaves a tombstone so other sessions see the deletion; returns it
     try:
-        messages_coll.delete_one({"_id": ObjectId(message_id), "sender": sender})
+        doc = messages_coll.find_one_and_update(
+            {"_id": ObjectId(message_id), "sender": sender, "deleted": {"$ne": True}},
+            {"$set": {"deleted": True, "content": "", "file_id": None, "updated_at": datetime.utcnow()},
+             "$unset": {"reactions": "", "reactors": ""}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if doc is None:
+            return None
+        if doc.get("file_id"):
+            delete_files([doc["file_id"]])
+        doc.update(deleted=True, content="", file_id=None)
+        _bucket_sync(doc)
+        return doc
     except Exception as e:
         logging.error(f"Error deleting message {message_id} by {sender}: {e}")
         raise
 
+@instrumented
 def edit_message(message_id, sender, new_content):
+    # Returns the updated message, or None if it isn't the sender's
     try:
-        messages_coll.update_one(
-            {"_id": ObjectId(message_id), "sender": sender},
-            {"$set": {"content": new_content, "edited": True, "edited_at": datetime.utcnow()}}
+        now = datetime.utcnow()
+        doc = messages_coll.find_one_and_update(
+            {"_id": ObjectId(message_id), "sender": sender, "deleted": {"$ne": True}},
+            {"$set": {"content": new_content, "edited": True, "edited_at": now, "updated_at": now}},
+            return_document=ReturnDocument.AFTER
         )
+        if doc is not None:
+            _bucket_sync(doc)
+        return doc
     except Exception as e:
         logging.error(f"Error editing message {message_id} by {sender}: {e}")
         raise
 
+@instrumented
 def mark_messages_read(username, partner):
     try:
+        now = datetime.utcnow()
+        # updated_at too, so live sessions and delta sync see the read receipt
         messages_coll.update_many(
-            {"sender": partner, "receiver": username, "read": False},
-            {"$set": {"read": True}}
+            {"conversation_key": conversation_key(username, partner), "sender": partner, "read": False},
+            {"$set": {"read": True, "updated_at": now}}
         )
         notes_coll.update_many(
-            {"user": username, "msg.sender": partner, "read": False},
-            {"$set": {"read": True}}
+            {"user": username, "msg.sender": partner, "msg.group": {"$exists": False}, "read": False},
+            {"$set": {"read": True, "read_at": now}}
         )
+        _reset_unread(username, conversation_key(username, partner))
     except Exception as e:
         logging.error(f"Error marking messages read for {username} from {partner}: {e}")
         raise
 
-def add_reaction(message_id, username, reaction):
+@instrumented
+def mark_group_read(username, group_name):
     try:
-        messages_coll.update_one(
-            {"_id": ObjectId(message_id)},
-            {"$inc": {f"reactions.{reaction}": 1}}
+        notes_coll.update_many(
+            {"user": username, "msg.group": group_name, "read": False},
+            {"$set": {"read": True, "read_at": datetime.utcnow()}}
         )
+        _reset_unread(username, conversation_key(group=group_name))
     except Exception as e:
-        logging.error(f"Error adding reaction to message {message_id} by {username}: {e}")
+        logging.error(f"Error marking group {group_name} read for {username}: {e}")
         raise
 
-def search_messages(query, username, p=None, g=None):
+# Reactions: reactors.<emoji> holds who reacted and reactions.<emoji> the
+# count; both change in the same single-document update, so they stay in step
+REACTIONS = ("👍", "❤️", "😂")
+
+def _check_reaction(reaction):
+    # Emoji become field names, so only known ones are accepted
+    if reaction not in REACTIONS:
+        raise ValueError(f"Unsupported reaction {reaction!r}")
+
+@instrumented
+def toggle_reaction(message_id, username, reaction):
+    # Adds the user's reaction, or removes it if already there; returns the
+    # message's updated {"reactions", "reactors", "updated_at"} for patching caches in place
+    try:
+        _check_reaction(reaction)
+        oid, field = ObjectId(message_id), f"reactors.{reaction}"
+        projection = {"reactions": 1, "reactors": 1, "updated_at": 1, "conversation_key": 1}
+        doc = messages_coll.find_one_and_update(
+            {"_id": oid, field: {"$ne": username}},
+            {"$addToSet": {field: username}, "$inc": {f"reactions.{reaction}": 1}, "$set": {"updated_at": datetime.utcnow()}},
+            projection=projection, return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            doc = messages_coll.find_one_and_update(
+                {"_id": oid, field: username},
+                {"$pull": {field: username}, "$inc": {f"reactions.{reaction}": -1}, "$set": {"updated_at": datetime.utcnow()}},
+                projection=projection, return_document=ReturnDocument.AFTER
+            )
+        if doc is None:
+            return None
+        _bucket_sync(doc, ("reactions", "reactors", "updated_at"))
+        return {"reactions": doc.get("reactions", {}), "reactors": doc.get("reactors", {}), "updated_at": doc.get("updated_at")}
+    except Exception as e:
+        logging.error(f"Error toggling reaction on message {message_id} by {username}: {e}")
+        raise
+
+# Search
+# "mongo" uses the $text index; "sqlite" uses the local FTS5 sidecar in
+# search_index.py (prefix matching, no text index load on the primary)
+SEARCH_BACKEND     = os.getenv("SEARCH_BACKEND", "mongo").lower()
+SEARCH_PAGE_SIZE   = 20
+SEARCH_SNIPPET_LEN = 160
+_MARKDOWN_SPECIAL  = re.compile(r"([\\`*_{}\[\]()#+\-.!|>~])")
+
+def _escape_md(text):
+    return _MARKDOWN_SPECIAL.sub(r"\\\1", text)
+
+def search_terms(query):
+    # Words the $text query matches on: quoted phrases and plain terms,
+    # without negated (-word) terms
+    return [t.strip('"') for t in re.findall(r'"[^"]+"|\S+', query) if not t.startswith("-") and t.strip('"')]
+
+def highlight(content, query, width=SEARCH_SNIPPET_LEN):
+    # Markdown snippet of content around the first match, matches in bold.
+    # $text matches stems, so any word starting with a term is highlighted.
+    terms = search_terms(query)
+    if not terms:
+        return _escape_md(content[:width])
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(t) for t in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(content)
+    start = max(0, (first.start() if first else 0) - width // 3)
+    text = content[start:start + width]
+    out, pos = [], 0
+    for m in pattern.finditer(text):
+        out.append(_escape_md(text[pos:m.start()]))
+        out.append(f"**{_escape_md(m.group())}**")
+        pos = m.end()
+    out.append(_escape_md(text[pos:]))
+    return ("…" if start else "") + "".join(out) + ("…" if start + width < len(content) else "")
+
+def user_conversation_keys(username):
+    # Every conversation the user belongs to: private rows plus group memberships
+    keys = [c["conversation_key"] for c in conversations_coll.find(
+        {"user": username, "partner": {"$exists": True}}, {"conversation_key": 1})]
+    keys += [conversation_key(group=grp["name"]) for grp in groups_coll.find({"members": username}, {"name": 1})]
+    return keys
+
+def _encode_search_cursor(doc):
+    return f"{doc['score']!r}:{doc['_id']}"
+
+def _decode_search_cursor(cursor):
+    score, oid = cursor.split(":", 1)
+    return float(score), ObjectId(oid)
+
+def _search_sidecar(query, keys, cursor, limit, **filters):
+    # Ids and scores come from the local index, documents from MongoDB
+    index = search_index.get_index()
+    if not index.ensure_built(messages_read_coll):
+        raise RuntimeError("The search index is still being built, please try again shortly")
+    index.catch_up(messages_read_coll, overlap=SYNC_OVERLAP)
+    after = _decode_search_cursor(cursor) if cursor else None
+    hits = index.search(query, keys, after=after, limit=limit + 1, **filters)
+    more = len(hits) > limit
+    hits = hits[:limit]
+    found = {d["_id"]: d for d in messages_read_coll.find(
+        {"_id": {"$in": [ObjectId(i) for i, _ in hits]}, "deleted": {"$ne": True}})}
+    docs, gone = [], []
+    for oid, score in hits:
+        d = found.get(ObjectId(oid))
+        if d is None:
+            gone.append(oid)  # hard-deleted, e.g. by an account deletion job
+            continue
+        d["score"] = score
+        d["snippet"] = highlight(d.get("content", ""), query)
+        docs.append(d)
+    if gone:
+        index.remove(gone)
+    return docs, (f"{hits[-1][1]!r}:{hits[-1][0]}" if more else None)
+
+@instrumented
+def search_messages(query, username, p=None, g=None, sender=None, since=None, until=None,
+                    has_file=None, cursor=None, limit=SEARCH_PAGE_SIZE):
+    # Relevance-ranked $text search, one page at a time.  Scoped to a private
+    # chat (p), a group (g), or every conversation the user belongs to.
+    # Returns (messages with "score" and "snippet", next cursor or None).
     try:
         if p:
-            return list(messages_coll.find(
-                {
-                    "$or": [{"sender": username, "receiver": p}, {"sender": p, "receiver": username}],
-                    "$text": {"$search": query}
-                }
-            ).sort("timestamp", -1))
+            keys = [conversation_key(username, p)]
         elif g:
-            return list(messages_coll.find(
-                {"group": g, "$text": {"$search": query}}
-            ).sort("timestamp", -1))
-        return []
+            keys = [conversation_key(group=g)]
+        else:
+            keys = user_conversation_keys(username)
+        if not keys or not query.strip():
+            return [], None
+        if SEARCH_BACKEND == "sqlite":
+            return _search_sidecar(query, keys, cursor, limit, sender=sender, since=since, until=until, has_file=has_file)
+        match = {"$text": {"$search": query}, "conversation_key": {"$in": keys}, "deleted": {"$ne": True}}
+        if sender:
+            match["sender"] = sender
+        if since or until:
+            match["timestamp"] = {k: v for k, v in (("$gte", since), ("$lt", until)) if v}
+        if has_file is not None:
+            match["file_id"] = {"$ne": None} if has_file else None
+        pipeline = [{"$match": match}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+        if cursor:
+            score, oid = _decode_search_cursor(cursor)
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": score}}, {"score": score, "_id": {"$lt": oid}}]}})
+        pipeline += [{"$sort": {"score": -1, "_id": -1}}, {"$limit": limit + 1}]
+        docs = list(messages_read_coll.aggregate(pipeline))
+        more = len(docs) > limit
+        docs = docs[:limit]
+        for d in docs:
+            d["snippet"] = highlight(d.get("content", ""), query)
+        return docs, (_encode_search_cursor(docs[-1]) if more else None)
     except Exception as e:
         logging.error(f"Error searching messages for {username}: {e}")
         raise
 
+# Migrations
+@instrumented
+def backfill_conversation_keys(batch_size=1000):
+    # Stamps conversation_key on messages written before the field existed,
+    # and re-keys private messages between users whose names contain "|" or a
+    # backslash, which were keyed without escaping
+    try:
+        escaped = {"$regex": r"[|\\]"}
+        query = {"$or": [
+            {"conversation_key": {"$exists": False}},
+            {"receiver": {"$exists": True}, "$or": [{"sender": escaped}, {"receiver": escaped}]},
+        ]}
+        updated = 0
+        for coll in (messages_coll, archive_coll):
+            batch = []
+            for doc in coll.find(query, {"sender": 1, "receiver": 1, "group": 1, "conversation_key": 1}):
+                key = conversation_key(group=doc["group"]) if doc.get("group") else conversation_key(doc["sender"], doc.get("receiver"))
+                if doc.get("conversation_key") == key:
+                    continue
+                # updated_at too, so the search sidecar picks up the new key
+                batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"conversation_key": key, "updated_at": datetime.utcnow()}}))
+                if len(batch) >= batch_size:
+                    updated += coll.bulk_write(batch, ordered=False).modified_count
+                    batch = []
+            if batch:
+                updated += coll.bulk_write(batch, ordered=False).modified_count
+        rows = [UpdateOne({"_id": row["_id"]}, {"$set": {"conversation_key": conversation_key(row["user"], row["partner"])}})
+                for row in conversations_coll.find({"partner": {"$exists": True}, "$or": [{"user": escaped}, {"partner": escaped}]},
+                                                   {"user": 1, "partner": 1})]
+        if rows:
+            conversations_coll.bulk_write(rows, ordered=False)
+        return updated
+    except Exception as e:
+        logging.error(f"Error backfilling conversation keys: {e}")
+        raise
+
+@instrumented
+def archive_messages(older_than_days=None, batch_size=1000):
+    # Moves messages older than the cutoff into the archive collection in
+    # batches.  Each batch is copied before it is removed, and re-copying is
+    # a no-op, so an interrupted run can simply be started again.  Tombstones
+    # are dropped rather than archived.  Returns the number of messages moved.
+    try:
+        days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        moved = 0
+        while True:
+            docs = list(messages_coll.find({"timestamp": {"$lt": cutoff}}).sort("timestamp", 1).limit(batch_size))
+            live = [d for d in docs if not d.get("deleted")]
+            if live:
+                try:
+                    archive_coll.insert_many(live, ordered=False)
+                except BulkWriteError as e:
+                    if any(err["code"] != 11000 for err in e.details.get("writeErrors", [])):
+                        raise
+            # Archived messages leave their buckets too, so bucket pages fall
+            # through to the archive (and its read-only marking) for them
+            keys = list({d["conversation_key"] for d in docs if bucketed(d.get("conversation_key") or "")})
+            if keys:
+                buckets_coll.update_many({"conversation_key": {"$in": keys}, "start_ts": {"$lt": cutoff}},
+                                         {"$pull": {"messages": {"_id": {"$in": [d["_id"] for d in docs]}}}})
+            if docs:
+                messages_coll.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+                archive_keys_cache.clear()
+                moved += len(live)
+            if len(docs) < batch_size:
+                # Buckets wholly past the cutoff are now empty
+                buckets_coll.delete_many({"end_ts": {"$lt": cutoff}})
+                return moved
+    except Exception as e:
+        logging.error(f"Error archiving messages: {e}")
+        raise
+
+@instrumented
+def backfill_read_at():
+    # One-off: read notifications from before the TTL index get read_at = ts
+    try:
+        return notes_coll.update_many(
+            {"read": True, "read_at": {"$exists": False}},
+            [{"$set": {"read_at": "$ts"}}]
+        ).modified_count
+    except Exception as e:
+        logging.error(f"Error backfilling read_at: {e}")
+        raise
+
+@instrumented
+def backfill_updated_at():
+    # One-off: messages written before versioning get updated_at = timestamp
+    try:
+        return messages_coll.update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": "$timestamp"}}]
+        ).modified_count
+    except Exception as e:
+        logging.error(f"Error backfilling updated_at: {e}")
+        raise
+
+@instrumented
+def migrate_files_to_gridfs():
+    # One-off: move inline blobs from files_coll into GridFS, keeping their _id
+    # so file_id references in messages and profiles stay valid
+    try:
+        moved = 0
+        for ref in files_coll.find({}, {"_id": 1}):
+            doc = files_coll.find_one({"_id": ref["_id"]})
+            if doc is None:
+                continue
+            try:
+                fs_bucket.upload_from_stream_with_id(
+                    doc["_id"], doc["name"], io.BytesIO(doc["content"]),
+                    metadata={"mime": _file_mime(doc["name"]), "migrated_at": datetime.utcnow()}
+                )
+            except FileExists:
+                pass  # copied by an earlier, interrupted run
+            files_coll.delete_one({"_id": doc["_id"]})
+            moved += 1
+        return moved
+    except Exception as e:
+        logging.error(f"Error migrating files to GridFS: {e}")
+        raise
+
+@instrumented
+def rebuild_conversations():
+    # Rebuild the conversations collection from private message history
+    try:
+        pipeline = [
+            {"$match": {"receiver": {"$exists": True}}},
+            {"$sort": {"timestamp": 1}},
+            {"$project": {
+                "timestamp": 1, "content": 1, "conversation_key": 1,
+                "sides": [
+                    {"user": "$sender", "partner": "$receiver", "unread": 0},
+                    {"user": "$receiver", "partner": "$sender",
+                     "unread": {"$cond": [{"$eq": ["$read", False]}, 1, 0]}}
+                ]
+            }},
+            {"$unwind": "$sides"},
+            {"$group": {
+                "_id": {"user": "$sides.user", "partner": "$sides.partner"},
+                "conversation_key": {"$last": "$conversation_key"},
+                "last_message_ts": {"$last": "$timestamp"},
+                "last_snippet": {"$last": "$content"},
+                "unread_count": {"$sum": "$sides.unread"}
+            }}
+        ]
+        written, batch = 0, []
+        for row in messages_coll.aggregate(pipeline, allowDiskUse=True):
+            user, partner = row["_id"]["user"], row["_id"]["partner"]
+            batch.append(UpdateOne({"user": user, "conversation_key": row["conversation_key"] or conversation_key(user, partner)}, {"$set": {
+                "partner": partner,
+                "last_message_ts": row["last_message_ts"],
+                "last_snippet": (row["last_snippet"] or "")[:SNIPPET_LENGTH],
+                "unread_count": row["unread_count"]
+            }}, upsert=True))
+            if len(batch) >= 1000:
+                written += conversations_coll.bulk_write(batch, ordered=False).upserted_count
+                batch = []
+        if batch:
+            written += conversations_coll.bulk_write(batch, ordered=False).upserted_count
+        return written
+    except Exception as e:
+        logging.error(f"Error rebuilding conversations: {e}")
+        raise
+
 # Groups
+@instrumented
 def list_rooms(username):
     try:
         return list(groups_coll.find({
@@ -284,6 +1629,7 @@ def list_rooms(username):
         logging.error(f"Error listing rooms for {username}: {e}")
         raise
 
+@instrumented
 def get_user_groups(username):
     try:
         return list(groups_coll.find({"members": username}))
@@ -291,6 +1637,7 @@ def get_user_groups(username):
         logging.error(f"Error fetching user groups for {username}: {e}")
         raise
 
+@instrumented
 def user_group_count(username):
     try:
         return groups_coll.count_documents({"creator": username})
@@ -298,6 +1645,7 @@ def user_group_count(username):
         logging.error(f"Error counting user groups for {username}: {e}")
         raise
 
+@instrumented
 def create_group(name, creator):
     try:
         groups_coll.insert_one({
@@ -311,6 +1659,7 @@ def create_group(name, creator):
         logging.error(f"Error creating group {name} by {creator}: {e}")
         raise
 
+@instrumented
 def invite_user_to_group(group, user):
     try:
         invites_coll.insert_one({"group": group, "invited_user": user, "status": "pending", "ts": datetime.utcnow()})
@@ -318,6 +1667,7 @@ def invite_user_to_group(group, user):
         logging.error(f"Error inviting {user} to group {group}: {e}")
         raise
 
+@instrumented
 def get_user_invites(username):
     try:
         return list(invites_coll.find({"invited_user": username}))
@@ -325,6 +1675,7 @@ def get_user_invites(username):
         logging.error(f"Error fetching invites for {username}: {e}")
         raise
 
+@instrumented
 def accept_invite(username, group_name):
     try:
         groups_coll.update_one({"name": group_name}, {"$addToSet": {"members": username}})
@@ -334,16 +1685,61 @@ def accept_invite(username, group_name):
         raise
 
 # Notifications
-def get_notifications(username):
+@instrumented
+def get_notifications(username, limit=0):
     try:
-        return list(notes_coll.find({"user": username, "read": False}))
+        return list(notes_coll.find({"user": username, "read": False}).sort("ts", -1).limit(limit))
     except Exception as e:
         logging.error(f"Error fetching notifications for {username}: {e}")
         raise
 
+@instrumented
 def mark_notifications_read(username):
     try:
-        notes_coll.update_many({"user": username, "read": False}, {"$set": {"read": True}})
+        notes_coll.update_many({"user": username, "read": False}, {"$set": {"read": True, "read_at": datetime.utcnow()}})
+        conversations_coll.update_many({"user": username, "unread_count": {"$gt": 0}}, {"$set": {"unread_count": 0}})
+        counters_coll.update_one({"_id": username}, {"$set": {"unread_total": 0}})
     except Exception as e:
         logging.error(f"Error marking notifications read for {username}: {e}")
-        raise
\ No newline at end of file
+        raise
+
+# Unread counters
+@instrumented
+def get_unread_count(username):
+    try:
+        doc = counters_coll.find_one({"_id": username}, {"unread_total": 1})
+        return doc.get("unread_total", 0) if doc else 0
+    except Exception as e:
+        logging.error(f"Error fetching unread count for {username}: {e}")
+        raise
+
+def _reset_unread(username, key):
+    # Zero one conversation and take what it held off the user's total
+    before = conversations_coll.find_one_and_update(
+        {"user": username, "conversation_key": key, "unread_count": {"$gt": 0}},
+        {"$set": {"unread_count": 0}},
+        projection={"unread_count": 1}
+    )
+    if before:
+        counters_coll.update_one({"_id": username}, [{"$set": {"unread_total": {
+            "$max": [0, {"$subtract": [{"$ifNull": ["$unread_total", 0]}, before["unread_count"]]}]
+        }}}])
+
+@instrumented
+def rebuild_unread_counters():
+    # Recompute every user's total from their unread notifications
+    try:
+        counters_coll.update_many({}, {"$set": {"unread_total": 0}})
+        batch = [
+            UpdateOne({"_id": row["_id"]}, {"$set": {"unread_total": row["n"]}}, upsert=True)
+            for row in notes_coll.aggregate([
+                {"$match": {"read": False}},
+                {"$group": {"_id": "$user", "n": {"$sum": 1}}}
+            ], allowDiskUse=True)
+        ]
+        if batch:
+            counters_coll.bulk_write(batch, ordered=False)
+        return len(batch)
+    except Exception as e:
+        logging.error(f"Error rebuilding unread counters: {e}")
+        raise
@@ -0,0 +1,296 @@
+import os
+import threading
+import time
+import logging
+from collections import deque
+from itertools import count
+from datetime import datetime
+from pymongo.errors import OperationFailure, PyMongoError
+
+import database
+from cache import LRUCache, MISSING
+from records import Message
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+LIVE_BUFFER_SIZE   = int(os.getenv("LIVE_BUFFER_SIZE", "200"))
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "1.0"))
+LIVE_RETRY_DELAY   = 5.0
+# Channels nobody has polled for this long are dropped
+LIVE_CHANNEL_IDLE  = float(os.getenv("LIVE_CHANNEL_IDLE", "300"))
+# Shared room cache: how many conversations to keep, and messages per conversation
+ROOM_CACHE_ROOMS   = int(os.getenv("ROOM_CACHE_ROOMS", "100"))
+ROOM_CACHE_SIZE    = int(os.getenv("ROOM_CACHE_SIZE", "200"))
+# Rooms are reloaded from the database at least this often (seconds)
+ROOM_CACHE_TTL     = float(os.getenv("ROOM_CACHE_TTL", "300"))
+
+# Error codes returned by servers that cannot open a change stream
+# (standalone mongod: 40573, older servers / unsupported stage: 40324)
+_NO_CHANGE_STREAM_CODES = {40573, 40324}
+
+
+# Sequence numbers are drawn from one process-wide counter, so a channel
+# recreated after pruning never reuses a number a session already holds
+_seq = count(1)
+
+
+class Channel:
+    # Per-conversation queue of recent message changes (inserts, edits,
+    # reactions, tombstones); seq increases with every change, and `floor` is
+    # the newest seq no longer covered by the buffer
+    def __init__(self):
+        self.floor = self.seq = next(_seq)
+        self.events = deque(maxlen=LIVE_BUFFER_SIZE)
+        self.cond = threading.Condition()
+        self.used_at = time.monotonic()
+
+    def push(self, doc):
+        with self.cond:
+            if len(self.events) == self.events.maxlen:
+                self.floor = self.events[0][0]
+            self.seq = next(_seq)
+            self.events.append((self.seq, doc))
+            self.cond.notify_all()
+
+    def since(self, seq):
+        # Returns None when the caller fell behind the buffer, or holds a seq
+        # from before this channel existed, and must refetch
+        with self.cond:
+            self.used_at = time.monotonic()
+            if seq < self.floor:
+                return None, self.seq
+            return [doc for s, doc in self.events if s > seq], self.seq
+
+    def wait(self, seq, timeout):
+        with self.cond:
+            self.used_at = time.monotonic()
+            if self.seq > seq:
+                return True
+            self.cond.wait(timeout)
+            return self.seq > seq
+
+
+class Room:
+    # Most recent messages of one conversation, shared read-only by every
+    # session viewing it.  Kept current by the hub's subscriber; changes that
+    # arrive while the first page is still loading are replayed afterwards.
+    def __init__(self, size=ROOM_CACHE_SIZE):
+        self.size = size
+        self.messages = []    # oldest first
+        self.cursor = None    # history cursor before messages[0]; None = no older messages
+        self.ready = False
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def fill(self, messages, cursor):
+        with self._lock:
+            self.messages, self.cursor = Message.from_docs(messages), cursor
+            for doc in self._pending:
+                self._merge(doc)
+            self._pending = []
+            self.ready = True
+
+    def apply(self, doc):
+        with self._lock:
+            if self.ready:
+                self._merge(doc)
+            else:
+                self._pending.append(doc)
+
+    def _merge(self, msg):
+        # Records are replaced, never mutated, so sessions holding references
+        # to the old version are unaffected
+        for i in range(len(self.messages) - 1, -1, -1):
+            if self.messages[i].id == msg.id:
+                if msg.deleted:
+                    del self.messages[i]
+                else:
+                    self.messages[i] = msg
+                return
+        if msg.deleted:
+            return
+        if self.cursor is not None and self.messages and msg.ts < self.messages[0].ts:
+            return  # an edit to a message older than the buffer
+        self.messages.append(msg)
+        if len(self.messages) > 1 and self.messages[-2].sort_key > msg.sort_key:
+            self.messages.sort(key=lambda m: m.sort_key)
+        if len(self.messages) > self.size:
+            del self.messages[:len(self.messages) - self.size]
+            self.cursor = self.messages[0].cursor
+
+    def recent(self, limit):
+        # Returns (records oldest-first, history cursor) like the DB loaders
+        with self._lock:
+            if limit >= len(self.messages):
+                return list(self.messages), self.cursor
+            page = self.messages[-limit:]
+            return page, page[0].cursor
+
+
+class LiveHub:
+    # Single process-wide subscriber on messages_coll that dispatches message
+    # changes to the channels sessions are listening on.  Uses a change stream
+    # when the server supports it and falls back to polling the updated_at
+    # version field on standalone servers.
+    def __init__(self, collection=None, poll_interval=LIVE_POLL_INTERVAL):
+        self._collection = collection
+        self.poll_interval = poll_interval
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._pruned_at = time.monotonic()
+        self._resume_token = None  # change stream position to resume from
+        self._since = None         # polling watermark, kept across restarts
+        self.mode = None
+        self.rooms = LRUCache(maxsize=ROOM_CACHE_ROOMS, ttl=ROOM_CACHE_TTL)
+
+    @property
+    def collection(self):
+        return self._collection if self._collection is not None else database.messages_coll
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="live-hub", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def channel(self, key):
+        with self._lock:
+            self._prune()
+            ch = self._channels.get(key)
+            if ch is None:
+                ch = self._channels[key] = Channel()
+            return ch
+
+    def _prune(self):
+        # Drops channels of conversations nobody has polled lately; a session
+        # coming back gets a fresh channel and refetches (see Channel.since)
+        now = time.monotonic()
+        if now - self._pruned_at < LIVE_CHANNEL_IDLE / 10:
+            return
+        self._pruned_at = now
+        for key in [k for k, ch in self._channels.items() if now - ch.used_at > LIVE_CHANNEL_IDLE]:
+            del self._channels[key]
+
+    # Session API
+    def cursor(self, key):
+        self.start()
+        return self.channel(key).seq
+
+    def poll(self, key, since):
+        return self.channel(key).since(since)
+
+    def wait(self, key, since, timeout):
+        return self.channel(key).wait(since, timeout)
+
+    def recent(self, key, loader, limit):
+        # First page of a conversation from the shared room cache.  On a miss
+        # the room is registered before `loader(size)` runs so changes made
+        # during the load are not lost; concurrent misses just use the loader.
+        self.start()
+        with self._lock:
+            room = self.rooms.get(key)
+            owner = room is MISSING
+            if owner:
+                room = Room()
+                self.rooms.set(key, room)
+        if owner:
+            try:
+                room.fill(*loader(room.size))
+            except Exception:
+                self.rooms.invalidate(key)
+                raise
+        elif not room.ready:
+            messages, cursor = loader(limit)
+            return Message.from_docs(messages), cursor
+        return room.recent(limit)
+
+    def dispatch(self, doc):
+        key = database.message_conversation_key(doc)
+        msg = Message.from_doc(doc)
+        room = self.rooms.peek(key)
+        if room is not MISSING:
+            room.apply(msg)
+        with self._lock:
+            ch = self._channels.get(key)
+        if ch is not None:  # nobody listening -> nothing to buffer
+            ch.push(msg)
+
+    # Subscriber
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.mode = "change_stream"
+                self._watch()
+            except (OperationFailure, NotImplementedError) as e:
+                # Standalone servers and in-memory stand-ins have no change streams
+                if isinstance(e, NotImplementedError) or e.code in _NO_CHANGE_STREAM_CODES or "replica set" in str(e):
+                    self.mode = "polling"
+                    try:
+                        self._poll()
+                    except PyMongoError as pe:
+                        logging.error(f"Live message polling failed: {pe}")
+                        self._missed()
+                        self._stop.wait(LIVE_RETRY_DELAY)
+                else:
+                    # Possibly an expired resume token: start over from now
+                    logging.error(f"Live message change stream failed: {e}")
+                    self._resume_token = None
+                    self._missed(resumable=False)
+                    self._stop.wait(LIVE_RETRY_DELAY)
+            except PyMongoError as e:
+                logging.error(f"Live message change stream failed: {e}")
+                self._missed()
+                self._stop.wait(LIVE_RETRY_DELAY)
+
+    def _missed(self, resumable=True):
+        # The subscriber stopped and may miss changes until it is back, so
+        # rooms reload from the database.  Channels are kept when the restart
+        # resumes from where it stopped; otherwise sessions must refetch too.
+        self.rooms.clear()
+        if not resumable:
+            with self._lock:
+                self._channels.clear()
+
+    def _watch(self):
+        if not callable(getattr(type(self.collection), "watch", None)):
+            # e.g. mongomock, whose __getattr__ would hand back a sub-collection
+            raise NotImplementedError(f"{type(self.collection).__name__} has no change streams")
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+        with self.collection.watch(pipeline, full_document="updateLookup", resume_after=self._resume_token) as stream:
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                self._resume_token = stream.resume_token
+                # fullDocument is None when the message was removed before lookup
+                if change is None or change.get("fullDocument") is None:
+                    continue
+                self.dispatch(change["fullDocument"])
+
+    def _poll(self):
+        # Re-reads SYNC_OVERLAP before the watermark, like get_conversation_changes,
+        # so a write that commits after a newer one was polled is still seen;
+        # `seen` holds the (_id, updated_at) versions already dispatched
+        # within that window so each version is dispatched once
+        if self._since is None:
+            self._since = datetime.utcnow()
+        seen = {}
+        while not self._stop.is_set():
+            floor = self._since - database.SYNC_OVERLAP
+            for doc in self.collection.find({"updated_at": {"$gte": floor}}).sort("updated_at", 1):
+                version = (doc["_id"], doc["updated_at"])
+                if version in seen:
+                    continue
+                seen[version] = doc["updated_at"]
+                self._since = max(self._since, doc["updated_at"])
+                self.dispatch(doc)
+            floor = self._since - database.SYNC_OVERLAP
+            seen = {v: ts for v, ts in seen.items() if ts >= floor}
+            self._stop.wait(self.poll_interval)
+
+hub = LiveHub()
@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from dotenv import load_dotenv
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Admin CLI for schema migrations and one-off maintenance tasks, e.g.
+#   python manage.py migrate
+#   python manage.py backfill-conversation-keys
+
+
+def cmd_init_db(args):
+    from database import init_db
+    started = time.perf_counter()
+    init_db()
+    print(f"Database initialized in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def cmd_migrate(args):
+    from database import ensure_indexes, backfill_conversation_keys, backfill_updated_at, backfill_read_at
+    started = time.perf_counter()
+    ensure_indexes()
+    print(f"Indexes up to date ({(time.perf_counter() - started) * 1000:.0f} ms)")
+    n = backfill_conversation_keys(batch_size=args.batch_size)
+    print(f"Stamped or re-keyed conversation_key on {n} messages")
+    n = backfill_updated_at()
+    print(f"Stamped updated_at on {n} messages")
+    n = backfill_read_at()
+    print(f"Stamped read_at on {n} read notifications")
+
+
+def cmd_backfill_conversation_keys(args):
+    from database import ensure_indexes, backfill_conversation_keys
+    ensure_indexes()
+    n = backfill_conversation_keys(batch_size=args.batch_size)
+    print(f"Stamped or re-keyed conversation_key on {n} messages")
+
+
+def cmd_migrate_files(args):
+    from database import ensure_indexes, migrate_files_to_gridfs
+    ensure_indexes()
+    n = migrate_files_to_gridfs()
+    print(f"Moved {n} files into GridFS")
+
+
+def cmd_rebuild_conversations(args):
+    from database import ensure_indexes, rebuild_conversations
+    ensure_indexes()
+    n = rebuild_conversations()
+    print(f"Created {n} conversation entries")
+
+
+def cmd_rebuild_unread_counters(args):
+    from database import ensure_indexes, rebuild_unread_counters
+    ensure_indexes()
+    n = rebuild_unread_counters()
+    print(f"Recomputed unread totals for {n} users")
+
+
+def cmd_archive(args):
+    from database import archive_messages, ARCHIVE_AFTER_DAYS
+    days = ARCHIVE_AFTER_DAYS if args.days is None else args.days
+    started = time.perf_counter()
+    n = archive_messages(older_than_days=days, batch_size=args.batch_size)
+    print(f"Archived {n} messages older than {days} days in {time.perf_counter() - started:.1f} s")
+
+
+def cmd_rebuild_buckets(args):
+    from database import groups_coll, rebuild_buckets, bucketed, conversation_key
+    names = args.groups or [g["name"] for g in groups_coll.find({}, {"name": 1})
+                            if bucketed(conversation_key(group=g["name"]))]
+    for name in names:
+        started = time.perf_counter()
+        n = rebuild_buckets(name)
+        print(f"{name}: {n} buckets in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def cmd_rebuild_search_index(args):
+    from database import messages_coll
+    from search_index import get_index
+    index = get_index(args.path)
+    started = time.perf_counter()
+    n = index.rebuild(messages_coll, batch_size=args.batch_size)
+    print(f"Indexed {n} messages into {index.path} ({index.size_bytes() / 1e6:.1f} MB) "
+          f"in {time.perf_counter() - started:.1f} s")
+
+
+def cmd_run_jobs(args):
+    from database import jobs_coll, retry_job, run_job
+    for job in list(jobs_coll.find({"state": {"$in": ["pending", "running", "failed"]}}, {"state": 1, "target": 1})):
+        started = time.perf_counter()
+        state = retry_job(job["_id"], wait=True) if job["state"] == "failed" else run_job(job["_id"])
+        print(f"Job {job['_id']} ({job['target']}): {state or 'held by another process'} "
+              f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def _read_jsonl(path):
+    # One message per line: {"sender", "receiver" | "group", "content", "timestamp" (ISO 8601)}
+    from datetime import datetime, timezone
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            m = json.loads(line)
+            if m.get("timestamp"):
+                ts = datetime.fromisoformat(m["timestamp"].replace("Z", "+00:00"))
+                if ts.tzinfo is not None:
+                    ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+                m["timestamp"] = ts
+            if not m.get("sender"):
+                raise ValueError(f"{path}:{lineno}: missing sender")
+            yield m
+
+
+def cmd_import_jsonl(args):
+    from database import ensure_indexes, create_messages_bulk, flush_notifications
+    ensure_indexes()
+    started = time.perf_counter()
+    total, batch = 0, []
+    for m in _read_jsonl(args.path):
+        batch.append(m)
+        if len(batch) >= args.batch_size:
+            total += len(create_messages_bulk(batch, batch_size=args.batch_size))
+            batch = []
+    if batch:
+        total += len(create_messages_bulk(batch, batch_size=args.batch_size))
+    flush_notifications()
+    elapsed = time.perf_counter() - started
+    print(f"Imported {total} messages in {elapsed:.1f} s ({total / max(elapsed, 1e-9):.0f} msg/s)")
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(prog="manage.py", description="Big Boss Chat maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("init-db", help="Create indexes and the default admin user and rooms")
+    p.set_defaults(func=cmd_init_db)
+
+    p = sub.add_parser("migrate", help="Apply index migrations and backfill new fields")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("backfill-conversation-keys", help="Add conversation_key to messages that predate it")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_backfill_conversation_keys)
+
+    p = sub.add_parser("migrate-files", help="Move inline attachment blobs into GridFS")
+    p.set_defaults(func=cmd_migrate_files)
+
+    p = sub.add_parser("rebuild-conversations", help="Rebuild the per-user conversation list from message history")
+    p.set_defaults(func=cmd_rebuild_conversations)
+
+    p = sub.add_parser("rebuild-unread-counters", help="Recompute unread totals from notifications")
+    p.set_defaults(func=cmd_rebuild_unread_counters)
+
+    p = sub.add_parser("archive", help="Move old messages into the messages_archive collection")
+    p.add_argument("--days", type=int, help="archive messages older than this (default: ARCHIVE_AFTER_DAYS)")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_archive)
+
+    p = sub.add_parser("rebuild-buckets", help="Rebuild message buckets for bucketed rooms (BUCKET_ROOMS)")
+    p.add_argument("groups", nargs="*", help="group names (default: every room in BUCKET_ROOMS)")
+    p.set_defaults(func=cmd_rebuild_buckets)
+
+    p = sub.add_parser("rebuild-search-index", help="Rebuild the local SQLite search index (SEARCH_BACKEND=sqlite)")
+    p.add_argument("--path", help="index file (default: SEARCH_INDEX_PATH)")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_rebuild_search_index)
+
+    p = sub.add_parser("run-jobs", help="Run unfinished background jobs (e.g. account deletions) to completion")
+    p.set_defaults(func=cmd_run_jobs)
+
+    p = sub.add_parser("import-jsonl", help="Import a JSONL chat export through the bulk send API")
+    p.add_argument("path")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_import_jsonl)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except Exception as e:
+        logging.error(f"Command {args.command} failed: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+import os
+import time
+import inspect
+import logging
+import threading
+import functools
+import contextvars
+from collections import deque, defaultdict
+import bson
+from pymongo import monitoring
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SLOW_QUERY_MS   = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Counting reply bytes re-encodes every reply, so it is off unless profiling
+REPLY_BYTES     = os.getenv("METRICS_REPLY_BYTES", "false").lower() in ("1", "true", "yes")
+LATENCY_SAMPLES = 2048
+SLOW_LOG_SIZE   = 200
+PERCENTILES     = (50, 95, 99)
+
+# database.py function currently executing on this thread/context
+_current_op = contextvars.ContextVar("current_op", default="(unattributed)")
+
+
+class OpStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.commands = 0
+        self.docs = 0
+        self.bytes = 0
+        self.call_ms = deque(maxlen=LATENCY_SAMPLES)
+        self.command_ms = deque(maxlen=LATENCY_SAMPLES)
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def query_shape(value):
+    # Replace literal values with "?" so queries group by structure, not data
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(v) for v in value[:3]]
+    return "?"
+
+
+def _command_shape(name, command):
+    for field in ("filter", "q", "query"):
+        if field in command:
+            return {name: query_shape(command[field])}
+    if "pipeline" in command:
+        return {name: query_shape(command["pipeline"])}
+    if "updates" in command:
+        return {name: query_shape(command["updates"][0].get("q", {}))} if command["updates"] else {name: {}}
+    if "deletes" in command:
+        return {name: query_shape(command["deletes"][0].get("q", {}))} if command["deletes"] else {name: {}}
+    return {name: {}}
+
+
+class Registry(monitoring.CommandListener):
+    # Collects per-function call counts and latencies (via @instrumented) and
+    # per-command latency, documents and, with METRICS_REPLY_BYTES, reply
+    # bytes (via pymongo events)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = defaultdict(OpStats)
+        self._inflight = {}
+        self.slow_ops = deque(maxlen=SLOW_LOG_SIZE)
+
+    # Function level
+    def record_call(self, op, ms, failed):
+        with self._lock:
+            st = self._ops[op]
+            st.calls += 1
+            st.errors += int(failed)
+            st.call_ms.append(ms)
+
+    # Command level
+    def started(self, event):
+        if event.command_name in ("isMaster", "hello", "ping", "endSessions"):
+            return
+        collection = event.command.get(event.command_name)
+        shape = _command_shape(event.command_name, event.command)
+        self._inflight[(event.request_id, event.connection_id)] = (_current_op.get(), collection, shape)
+
+    def succeeded(self, event):
+        info = self._inflight.pop((event.request_id, event.connection_id), None)
+        if info is None:
+            return
+        op, collection, shape = info
+        ms = event.duration_micros / 1000
+        reply = event.reply
+        cursor = reply.get("cursor") or {}
+        batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+        docs = len(batch) if batch is not None else reply.get("n", 0)
+        size = len(bson.encode(reply)) if REPLY_BYTES and batch else 0
+        with self._lock:
+            st = self._ops[op]
+            st.commands += 1
+            st.docs += docs
+            st.bytes += size
+            st.command_ms.append(ms)
+        if ms >= SLOW_QUERY_MS:
+            # Kept for the admin page's slow operations table
+            self.slow_ops.append({"ts": time.time(), "op": op, "collection": collection,
+                                  "ms": round(ms, 2), "docs": docs, "shape": shape})
+
+    def failed(self, event):
+        info = self._inflight.pop((event.request_id, event.connection_id), None)
+        if info is None:
+            return
+        with self._lock:
+            self._ops[info[0]].errors += 1
+
+    # Reporting
+    def snapshot(self):
+        with self._lock:
+            out = {}
+            for op, st in self._ops.items():
+                row = {"calls": st.calls, "errors": st.errors, "commands": st.commands, "docs": st.docs, "bytes": st.bytes}
+                for p in PERCENTILES:
+                    row[f"p{p}_ms"] = round(percentile(st.call_ms, p), 2)
+                    row[f"db_p{p}_ms"] = round(percentile(st.command_ms, p), 2)
+                out[op] = row
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+            self.slow_ops.clear()
+
+    def prometheus_text(self):
+        lines = [
+            "# TYPE chat_db_calls_total counter",
+            "# TYPE chat_db_errors_total counter",
+            "# TYPE chat_db_commands_total counter",
+            "# TYPE chat_db_documents_total counter",
+            "# TYPE chat_db_bytes_total counter",
+            "# TYPE chat_db_latency_ms summary",
+        ]
+        for op, row in sorted(self.snapshot().items()):
+            lbl = f'op="{op}"'
+            lines.append(f"chat_db_calls_total{{{lbl}}} {row['calls']}")
+            lines.append(f"chat_db_errors_total{{{lbl}}} {row['errors']}")
+            lines.append(f"chat_db_commands_total{{{lbl}}} {row['commands']}")
+            lines.append(f"chat_db_documents_total{{{lbl}}} {row['docs']}")
+            lines.append(f"chat_db_bytes_total{{{lbl}}} {row['bytes']}")
+            for p in PERCENTILES:
+                lines.append(f'chat_db_latency_ms{{{lbl},quantile="{p / 100}"}} {row[f"p{p}_ms"]}')
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def instrumented(fn):
+    # Attributes every Mongo command issued inside fn to fn's name and times the call
+    op = fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+        # Streams are attributed step by step, since the consumer runs between steps
+        @functools.wraps(fn)
+        def gen_wrapper(*args, **kwargs):
+            gen = fn(*args, **kwargs)
+            started, failed = time.perf_counter(), False
+            try:
+                while True:
+                    token = _current_op.set(op)
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                    finally:
+                        _current_op.reset(token)
+                    yield item
+            except GeneratorExit:
+                gen.close()
+                raise
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                registry.record_call(op, (time.perf_counter() - started) * 1000, failed)
+        return gen_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current_op.set(op)
+        started, failed = time.perf_counter(), False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            registry.record_call(op, (time.perf_counter() - started) * 1000, failed)
+            _current_op.reset(token)
+    return wrapper
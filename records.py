@@ -0,0 +1,97 @@
+import sys
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_ms(dt):
+    return (dt - _EPOCH) // timedelta(milliseconds=1)
+
+
+def from_ms(ms):
+    return _EPOCH + timedelta(milliseconds=ms)
+
+
+def _names(names):
+    return [sys.intern(n) for n in names]
+
+
+class Message:
+    # Compact, immutable-by-convention form of a message document for the
+    # chat caches (session state, live hub buffers, room cache).  Sender names
+    # are interned so every session shares one string per user, timestamps are
+    # epoch milliseconds, and empty reaction maps are stored as None.
+    # `archived` marks messages read from messages_archive, which are read-only.
+    __slots__ = ("id", "sender", "content", "ts", "version", "file_id",
+                 "edited", "read", "deleted", "reactions", "reactors", "archived")
+
+    def __init__(self, id, sender, content, ts, version=None, file_id=None,
+                 edited=False, read=False, deleted=False, reactions=None, reactors=None,
+                 archived=False):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.content = content
+        self.ts = ts
+        self.version = ts if version is None else version
+        self.file_id = file_id
+        self.edited = edited
+        self.read = read
+        self.deleted = deleted
+        self.reactions = reactions or None
+        self.reactors = reactors or None
+        self.archived = archived
+
+    @staticmethod
+    def reaction_fields(doc):
+        # reactions/reactors from a message document (or a toggle_reaction
+        # result), dropping zero counts and interning reactor names
+        return {
+            "reactions": {r: n for r, n in (doc.get("reactions") or {}).items() if n > 0} or None,
+            "reactors": {r: _names(names) for r, names in (doc.get("reactors") or {}).items() if names} or None,
+        }
+
+    @classmethod
+    def from_doc(cls, doc):
+        ts = to_ms(doc["timestamp"])
+        updated = doc.get("updated_at")
+        return cls(
+            doc["_id"], doc["sender"], doc.get("content") or "", ts,
+            version=to_ms(updated) if updated else ts,
+            file_id=str(doc["file_id"]) if doc.get("file_id") else None,
+            edited=bool(doc.get("edited")),
+            read=bool(doc.get("read")),
+            deleted=bool(doc.get("deleted")),
+            archived=bool(doc.get("archived")),
+            **cls.reaction_fields(doc)
+        )
+
+    @classmethod
+    def from_docs(cls, docs):
+        return [cls.from_doc(d) for d in docs]
+
+    def replace(self, **changes):
+        # Records are shared between sessions, so updates build a new one
+        new = object.__new__(Message)
+        for name in self.__slots__:
+            setattr(new, name, changes[name] if name in changes else getattr(self, name))
+        return new
+
+    @property
+    def timestamp(self):
+        return from_ms(self.ts)
+
+    @property
+    def updated_at(self):
+        return from_ms(self.version)
+
+    @property
+    def sort_key(self):
+        return self.ts, self.id
+
+    @property
+    def cursor(self):
+        # Same format as database.encode_cursor
+        return f"{self.ts}:{self.id}"
+
+    def __repr__(self):
+        return f"Message({self.id}, {self.sender!r}, {self.content[:20]!r})"
@@ -0,0 +1,240 @@
+import os
+import re
+import sqlite3
+import threading
+import logging
+from datetime import datetime, timedelta
+
+# Configure logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search_index.db")
+SEARCH_SYNC_BATCH = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    conversation_key TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    has_file INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_conversation ON docs (conversation_key, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+    content, tokenize = 'porter unicode61', prefix = '2 3'
+);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _ms(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def fts_query(query):
+    # Mongo $text syntax -> FTS5: "phrases" stay phrases, -term becomes NOT,
+    # and plain terms match as prefixes ("deplo" finds "deploy", "deployed")
+    include, exclude = [], []
+    for token in re.findall(r'-?"[^"]+"|\S+', query):
+        negate = token.startswith("-")
+        token = token.lstrip("-")
+        if token.startswith('"'):
+            term = '"' + token.strip('"').replace('"', '') + '"'
+        else:
+            word = re.sub(r"[^\w]", "", token)
+            if not word:
+                continue
+            term = f'"{word}"*'
+        (exclude if negate else include).append(term)
+    if not include:
+        return None
+    expr = " OR ".join(include)
+    for term in exclude:
+        expr = f"({expr}) NOT {term}"
+    return expr
+
+
+class SearchIndex:
+    # Embedded SQLite FTS5 index of message content, kept next to the app on
+    # local disk.  Fed from MongoDB by the updated_at version field (inserts,
+    # edits and tombstones all bump it), so every process can keep its own
+    # copy current with a cheap catch-up query before searching.
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._loader = None
+        with self._write_lock:
+            self.conn.executescript(_SCHEMA)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Sync state
+    def watermark(self):
+        row = self.conn.execute("SELECT value FROM state WHERE key = 'watermark'").fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def _set_watermark(self, conn, ts):
+        conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('watermark', ?)", (ts.isoformat(),))
+
+    # Writes
+    def apply(self, docs, advance=True):
+        # Upserts messages and drops tombstones; idempotent, so overlapping
+        # catch-ups are harmless.  Returns the newest updated_at applied and,
+        # with `advance`, moves the watermark up to it.
+        newest = None
+        with self._write_lock, self.conn as conn:
+            for doc in docs:
+                oid = str(doc["_id"])
+                row = conn.execute("SELECT rowid FROM docs WHERE id = ?", (oid,)).fetchone()
+                if row:
+                    conn.execute("DELETE FROM docs_fts WHERE rowid = ?", row)
+                    conn.execute("DELETE FROM docs WHERE rowid = ?", row)
+                if not doc.get("deleted"):
+                    cur = conn.execute(
+                        "INSERT INTO docs (id, conversation_key, sender, ts, has_file) VALUES (?, ?, ?, ?, ?)",
+                        (oid, doc["conversation_key"], doc["sender"], _ms(doc["timestamp"]), int(bool(doc.get("file_id"))))
+                    )
+                    conn.execute("INSERT INTO docs_fts (rowid, content) VALUES (?, ?)", (cur.lastrowid, doc.get("content") or ""))
+                updated = doc.get("updated_at") or doc["timestamp"]
+                if newest is None or updated > newest:
+                    newest = updated
+            if advance and newest is not None:
+                current = self.watermark()
+                if current is None or newest > current:
+                    self._set_watermark(conn, newest)
+        return newest
+
+    def remove(self, ids):
+        with self._write_lock, self.conn as conn:
+            for oid in ids:
+                row = conn.execute("SELECT rowid FROM docs WHERE id = ?", (str(oid),)).fetchone()
+                if row:
+                    conn.execute("DELETE FROM docs_fts WHERE rowid = ?", row)
+                    conn.execute("DELETE FROM docs WHERE rowid = ?", row)
+
+    def ensure_built(self, collection):
+        # True once the index has a watermark.  An index that was never built
+        # is loaded by rebuild() on a background thread instead of by the first
+        # search; `python manage.py rebuild-search-index` does it up front.
+        if self.watermark() is not None:
+            return True
+        with self._write_lock:
+            if self._loader is None or not self._loader.is_alive():
+                self._loader = threading.Thread(target=self._initial_load, args=(collection,),
+                                                name="search-index-load", daemon=True)
+                self._loader.start()
+        return False
+
+    def _initial_load(self, collection):
+        try:
+            self.rebuild(collection)
+        except Exception as e:
+            logging.error(f"Error building search index {self.path}: {e}")
+
+    def catch_up(self, collection, overlap=timedelta(0)):
+        # Applies every message changed since the watermark, re-reading
+        # `overlap` before it to tolerate clock skew; returns how many
+        since = self.watermark()
+        since = since - overlap if since else datetime(1970, 1, 1)
+        total = 0
+        while True:
+            docs = list(collection.find(
+                {"updated_at": {"$gte": since}},
+                {"sender": 1, "content": 1, "conversation_key": 1, "timestamp": 1,
+                 "updated_at": 1, "file_id": 1, "deleted": 1}
+            ).sort("updated_at", 1).limit(SEARCH_SYNC_BATCH))
+            if not docs:
+                return total
+            self.apply(docs)
+            total += len(docs)
+            if len(docs) < SEARCH_SYNC_BATCH or docs[-1]["updated_at"] == since:
+                return total
+            since = docs[-1]["updated_at"]
+
+    def rebuild(self, collection, batch_size=SEARCH_SYNC_BATCH):
+        # Drops the index and reloads every message, walking by _id
+        started = datetime.utcnow()
+        with self._write_lock, self.conn as conn:
+            conn.execute("DELETE FROM docs")
+            conn.execute("DELETE FROM docs_fts")
+            conn.execute("DELETE FROM state")
+        total, last = 0, None
+        projection = {"sender": 1, "content": 1, "conversation_key": 1, "timestamp": 1, "file_id": 1, "deleted": 1}
+        while True:
+            query = {"deleted": {"$ne": True}}
+            if last is not None:
+                query["_id"] = {"$gt": last}
+            docs = list(collection.find(query, projection).sort("_id", 1).limit(batch_size))
+            if not docs:
+                break
+            self.apply(docs, advance=False)  # no watermark until the load completes
+            total += len(docs)
+            last = docs[-1]["_id"]
+        # Changes made while rebuilding are picked up by the next catch_up
+        with self._write_lock, self.conn as conn:
+            self._set_watermark(conn, started)
+            conn.execute("INSERT INTO docs_fts (docs_fts) VALUES ('optimize')")
+        return total
+
+    # Reads
+    def search(self, query, keys, sender=None, since=None, until=None, has_file=None, after=None, limit=20):
+        # Returns [(message id, score)] best first; score is -bm25 so higher is
+        # better, and `after` is a (score, id) keyset position
+        expr = fts_query(query)
+        if expr is None or not keys:
+            return []
+        where = [f"d.conversation_key IN ({','.join('?' * len(keys))})"]
+        params = [expr] + list(keys)
+        if sender:
+            where.append("d.sender = ?")
+            params.append(sender)
+        if since:
+            where.append("d.ts >= ?")
+            params.append(_ms(since))
+        if until:
+            where.append("d.ts < ?")
+            params.append(_ms(until))
+        if has_file is not None:
+            where.append("d.has_file = ?")
+            params.append(int(has_file))
+        sql = f"""
+            SELECT id, score FROM (
+                SELECT d.id AS id, -bm25(docs_fts) AS score
+                FROM docs_fts JOIN docs d ON d.rowid = docs_fts.rowid
+                WHERE docs_fts MATCH ? AND {' AND '.join(where)}
+            )
+        """
+        if after is not None:
+            sql += " WHERE score < ? OR (score = ? AND id < ?)"
+            params += [after[0], after[0], str(after[1])]
+        sql += " ORDER BY score DESC, id DESC LIMIT ?"
+        params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+    def size_bytes(self):
+        return sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index(path=None):
+    # Process-wide index, opened on first use
+    global _index
+    with _index_lock:
+        if _index is None or (path and _index.path != path):
+            _index = SearchIndex(path or SEARCH_INDEX_PATH)
+        return _index
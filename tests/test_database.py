@@ -0,0 +1,126 @@
+import unittest
+from datetime import datetime, timedelta
+
+import mongomock
+
+import database
+
+# Query-level checks against mongomock (python -m unittest tests.test_database)
+
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        database.use_client(mongomock.MongoClient(), "test_chat")
+        database.NOTIFY_ASYNC = False
+
+    def test_read_receipt_bumps_version(self):
+        database.create_message("alice", receiver="bob", content="hi")
+        key = database.conversation_key("alice", "bob")
+        sent_at = datetime.utcnow() - timedelta(minutes=5)
+        database.messages_coll.update_many({}, {"$set": {"updated_at": sent_at}})
+        watermark = sent_at + timedelta(minutes=1)
+        self.assertEqual(database.get_conversation_changes(key, watermark), [])
+        database.mark_messages_read("bob", "alice")
+        changes = database.get_conversation_changes(key, watermark)
+        self.assertEqual(len(changes), 1)
+        self.assertTrue(changes[0]["read"])
+
+    def test_private_keys_do_not_collide(self):
+        self.assertNotEqual(database.conversation_key("a|b", "c"), database.conversation_key("a", "b|c"))
+        self.assertNotEqual(database.conversation_key("a\\", "|b"), database.conversation_key("a", "\\|b"))
+        self.assertEqual(database.conversation_key("bob", "alice"), "p:alice|bob")
+
+    def test_backfill_rekeys_unescaped_private_messages(self):
+        database.messages_coll.insert_many([
+            {"sender": "a|b", "receiver": "c", "content": "one", "conversation_key": "p:a|b|c",
+             "timestamp": datetime.utcnow()},
+            {"sender": "a", "receiver": "b|c", "content": "two", "conversation_key": "p:a|b|c",
+             "timestamp": datetime.utcnow()},
+        ])
+        self.assertEqual(database.backfill_conversation_keys(), 2)
+        self.assertEqual(database.backfill_conversation_keys(), 0)
+        one = database.messages_coll.find_one({"content": "one"})
+        two = database.messages_coll.find_one({"content": "two"})
+        self.assertEqual(one["conversation_key"], database.conversation_key("a|b", "c"))
+        self.assertEqual(two["conversation_key"], database.conversation_key("a", "b|c"))
+
+    def test_deleting_a_user_clears_partners_unread(self):
+        database.users_coll.insert_many([{"username": u} for u in ("alice", "bob", "carol")])
+        for i in range(3):
+            database.create_message("alice", receiver="bob", content=f"hi {i}")
+        database.create_message("carol", receiver="bob", content="hey")
+        self.assertEqual(database.get_unread_count("bob"), 4)
+        database.delete_user("alice", wait=True)
+        self.assertEqual(database.get_unread_count("bob"), 1)
+
+    def test_history_continues_into_archive_read_only(self):
+        for i in range(5):
+            database.create_message("alice", receiver="bob", content=f"m{i}")
+        old = datetime.utcnow() - timedelta(days=database.ARCHIVE_AFTER_DAYS + 1)
+        for i in range(3):
+            database.messages_coll.update_one({"content": f"m{i}"}, {"$set": {"timestamp": old + timedelta(seconds=i)}})
+        self.assertEqual(database.archive_messages(), 3)
+        docs, cursor = database.get_private_conversation("alice", "bob", limit=10)
+        self.assertIsNone(cursor)
+        self.assertEqual([d["content"] for d in docs], [f"m{i}" for i in range(5)])
+        self.assertEqual([bool(d.get("archived")) for d in docs], [True] * 3 + [False] * 2)
+
+    def test_short_pages_skip_the_archive_once_known_empty(self):
+        database.create_message("alice", receiver="bob", content="hi")
+        database.get_private_conversation("alice", "bob", limit=10)
+        key = database.conversation_key("alice", "bob")
+        self.assertIs(database.archive_keys_cache.peek(key), False)
+
+    def test_bulk_send_fills_buckets_in_order(self):
+        database.groups_coll.insert_one({"name": "busy", "members": ["alice", "bob"]})
+        old_rooms, old_size = database.BUCKET_ROOMS, database.BUCKET_SIZE
+        database.BUCKET_ROOMS, database.BUCKET_SIZE = "busy", 4
+        try:
+            database.create_message("alice", group="busy", content="first")
+            database.create_messages_bulk({"sender": "bob", "group": "busy", "content": f"b{i}"} for i in range(9))
+            buckets = list(database.buckets_coll.find().sort("_id", 1))
+            self.assertEqual([b["count"] for b in buckets], [4, 4, 2])
+            contents = [m["content"] for b in buckets for m in b["messages"]]
+            self.assertEqual(contents, ["first"] + [f"b{i}" for i in range(9)])
+            docs, cursor = database.get_group_conversation("busy", limit=20)
+            self.assertEqual([d["content"] for d in docs], contents)
+        finally:
+            database.BUCKET_ROOMS, database.BUCKET_SIZE = old_rooms, old_size
+
+    def test_deleting_a_user_clears_group_unread_and_notifications(self):
+        database.users_coll.insert_many([{"username": u} for u in ("a", "b", "c")])
+        database.groups_coll.insert_one({"name": "team", "members": ["a", "b", "c"]})
+        for i in range(5):
+            database.create_message("a", group="team", content=f"a{i}")
+        database.create_message("b", group="team", content="from b")
+        self.assertEqual(database.get_unread_count("b"), 5)
+        self.assertEqual(database.get_unread_count("c"), 6)
+        database.delete_user("a", wait=True)
+        self.assertEqual(database.get_unread_count("b"), 0)
+        self.assertEqual(database.get_unread_count("c"), 1)
+        key = database.conversation_key(group="team")
+        row = database.conversations_coll.find_one({"user": "c", "conversation_key": key})
+        self.assertEqual(row["unread_count"], 1)
+        self.assertEqual(database.notes_coll.count_documents({"msg.sender": "a"}), 0)
+
+    def test_archived_messages_leave_their_buckets(self):
+        database.groups_coll.insert_one({"name": "busy", "members": ["alice", "bob"]})
+        old_rooms, old_size = database.BUCKET_ROOMS, database.BUCKET_SIZE
+        database.BUCKET_ROOMS, database.BUCKET_SIZE = "busy", 4
+        try:
+            for i in range(6):
+                database.create_message("alice", group="busy", content=f"m{i}")
+            old = datetime.utcnow() - timedelta(days=database.ARCHIVE_AFTER_DAYS + 1)
+            for i in range(2):
+                database.messages_coll.update_one({"content": f"m{i}"}, {"$set": {"timestamp": old + timedelta(seconds=i)}})
+            database.rebuild_buckets("busy")
+            self.assertEqual(database.archive_messages(), 2)
+            docs, _ = database.get_group_conversation("busy", limit=20)
+            self.assertEqual([d["content"] for d in docs], [f"m{i}" for i in range(6)])
+            self.assertEqual([bool(d.get("archived")) for d in docs], [True] * 2 + [False] * 4)
+        finally:
+            database.BUCKET_ROOMS, database.BUCKET_SIZE = old_rooms, old_size
+
+
+if __name__ == "__main__":
+    unittest.main()
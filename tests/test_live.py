@@ -0,0 +1,133 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import mongomock
+from bson import ObjectId
+
+import live
+from live import LiveHub
+
+# Local harness for the live hub against mongomock, a replica-set-less
+# stand-in with no change streams, so the hub must run in polling mode
+# (needs mongomock, like the benchmarks):
+#   python -m unittest tests.test_live
+
+
+def _message(key="g:3D Chat", content="hello", **extra):
+    now = datetime.utcnow()
+    doc = {"_id": ObjectId(), "sender": "alice", "group": key[2:], "conversation_key": key,
+           "content": content, "timestamp": now, "updated_at": now, "file_id": None,
+           "read": False, "reactions": {}}
+    doc.update(extra)
+    return doc
+
+
+def _until(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class LiveHubStandInTest(unittest.TestCase):
+    def setUp(self):
+        self.coll = mongomock.MongoClient().db.messages
+        self.hub = LiveHub(collection=self.coll, poll_interval=0.02)
+
+    def tearDown(self):
+        self.hub.stop()
+
+    def test_falls_back_to_polling(self):
+        self.hub.cursor("g:3D Chat")
+        self.assertTrue(_until(lambda: self.hub.mode == "polling"))
+        time.sleep(0.1)
+        self.assertTrue(self.hub._thread.is_alive())
+
+    def test_delivers_inserts_and_edits(self):
+        key = "g:3D Chat"
+        seq = self.hub.cursor(key)
+        self.assertTrue(_until(lambda: self.hub.mode == "polling"))
+        time.sleep(0.05)  # let the poller take its starting watermark
+        doc = _message(key)
+        self.coll.insert_one(doc)
+        self.assertTrue(self.hub.wait(key, seq, timeout=3.0))
+        changes, seq = self.hub.poll(key, seq)
+        self.assertEqual([m.id for m in changes], [doc["_id"]])
+
+        time.sleep(0.01)
+        self.coll.update_one({"_id": doc["_id"]}, {"$set": {"content": "edited", "edited": True,
+                                                            "updated_at": datetime.utcnow()}})
+        self.assertTrue(self.hub.wait(key, seq, timeout=3.0))
+        changes, _ = self.hub.poll(key, seq)
+        self.assertEqual(changes[-1].content, "edited")
+
+    def test_late_commit_with_earlier_version_is_delivered(self):
+        key = "g:3D Chat"
+        seq = self.hub.cursor(key)
+        self.assertTrue(_until(lambda: self.hub.mode == "polling"))
+        time.sleep(0.05)
+        now = datetime.utcnow()
+        b = _message(key, "B", updated_at=now + timedelta(milliseconds=500))
+        self.coll.insert_one(b)
+        self.assertTrue(self.hub.wait(key, seq, timeout=3.0))
+        changes, seq = self.hub.poll(key, seq)
+        self.assertEqual([m.content for m in changes], ["B"])
+
+        # A was stamped before B but only commits now
+        self.coll.insert_one(_message(key, "A", updated_at=now))
+        self.assertTrue(self.hub.wait(key, seq, timeout=3.0))
+        time.sleep(0.1)  # a few more polls must not redeliver either one
+        changes, _ = self.hub.poll(key, seq)
+        self.assertEqual([m.content for m in changes], ["A"])
+
+    def test_other_conversations_are_not_woken(self):
+        seq = self.hub.cursor("g:quiet")
+        self.assertTrue(_until(lambda: self.hub.mode == "polling"))
+        self.coll.insert_one(_message("g:busy"))
+        self.assertFalse(self.hub.wait("g:quiet", seq, timeout=0.2))
+
+    def test_pruned_channel_forces_refetch(self):
+        key = "g:3D Chat"
+        seq = self.hub.cursor(key)
+        self.hub._channels[key].used_at -= live.LIVE_CHANNEL_IDLE + 1
+        self.hub._pruned_at -= live.LIVE_CHANNEL_IDLE
+        self.hub.channel("g:other")
+        self.assertNotIn(key, self.hub._channels)
+        changes, new_seq = self.hub.poll(key, seq)
+        self.assertIsNone(changes)
+        self.assertEqual(self.hub.poll(key, new_seq), ([], new_seq))
+
+    def test_rooms_reload_after_invalidate_and_subscriber_restart(self):
+        key = "g:3D Chat"
+        docs = [_message(key, f"m{i}") for i in range(3)]
+        loads = []
+
+        def loader(n):
+            loads.append(n)
+            return docs[-n:], None
+
+        self.hub.recent(key, loader, 2)
+        self.hub.recent(key, loader, 2)
+        self.assertEqual(len(loads), 1)
+        self.hub.rooms.invalidate(key)
+        self.hub.recent(key, loader, 2)
+        self.assertEqual(len(loads), 2)
+        self.hub._missed()
+        self.hub.recent(key, loader, 2)
+        self.assertEqual(len(loads), 3)
+
+    def test_fell_behind_buffer(self):
+        key = "g:3D Chat"
+        ch = self.hub.channel(key)
+        seq = ch.seq
+        for i in range(live.LIVE_BUFFER_SIZE + 1):
+            ch.push(i)
+        self.assertIsNone(ch.since(seq)[0])
+        self.assertEqual(len(ch.since(ch.events[0][0] - 1)[0]), live.LIVE_BUFFER_SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import mongomock
+from bson import ObjectId
+
+from search_index import SearchIndex
+
+# SQLite sidecar against a mongomock collection (python -m unittest tests.test_search_index)
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.coll = mongomock.MongoClient().db.messages
+        now = datetime.utcnow()
+        self.coll.insert_many([{"_id": ObjectId(), "sender": "alice", "conversation_key": "g:3D Chat",
+                                "content": f"deploy number {i}", "timestamp": now, "updated_at": now,
+                                "file_id": None} for i in range(30)])
+        self.index = SearchIndex(os.path.join(tempfile.mkdtemp(), "index.db"))
+
+    def test_first_search_does_not_load_inline(self):
+        self.assertFalse(self.index.ensure_built(self.coll))
+        self.index._loader.join(5)
+        self.assertTrue(self.index.ensure_built(self.coll))
+        self.assertEqual(self.index.count(), 30)
+        self.assertEqual(len(self.index.search("deplo", ["g:3D Chat"], limit=50)), 30)
+
+    def test_rebuild_sets_watermark_only_when_done(self):
+        self.index.apply(self.coll.find().limit(5), advance=False)
+        self.assertIsNone(self.index.watermark())
+        started = datetime.utcnow()
+        time.sleep(0.01)
+        self.index.rebuild(self.coll)
+        self.assertGreaterEqual(self.index.watermark(), started)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import streamlit as st
+from database import db_health, startup_timings, profile_cache, file_cache, list_jobs, job_fraction, retry_job
+from metrics import registry
+from live import hub
+
+def show_admin():
+    st.title("Admin 🛠️")
+    if not st.session_state.get("is_admin"):
+        st.error("Admins only.")
+        return
+
+    st.header("Database")
+    health = db_health()
+    if health["ok"]:
+        st.success(f"Connected · ping {health['ping_ms']} ms")
+    else:
+        st.error(f"Database unreachable: {health['error']}")
+    st.json({"pool": health["pool"], "startup_timings": startup_timings})
+
+    st.header("Caches")
+    st.table([
+        dict(name="profiles", **profile_cache.stats()),
+        dict(name="files", **file_cache.stats()),
+        dict(name="rooms", **hub.rooms.stats()),
+    ])
+
+    st.header("Background jobs")
+    jobs = list_jobs()
+    if jobs:
+        for job in jobs:
+            st.progress(job_fraction(job), text=f"{job['type']} {job['target']} · {job['state']} · {job['step'] or 'finished'}")
+            if job.get("error"):
+                st.caption(f"Error: {job['error']}")
+            if job["state"] == "failed" and st.button("Resume", key=f"retry_job_{job['_id']}"):
+                retry_job(job["_id"])
+                st.rerun()
+    else:
+        st.write("No jobs.")
+
+    st.header("Queries by function")
+    rows = [dict(function=op, **row) for op, row in registry.snapshot().items()]
+    rows.sort(key=lambda r: r["calls"] * r["p50_ms"], reverse=True)
+    if rows:
+        st.dataframe(rows, use_container_width=True)
+    else:
+        st.write("No queries recorded yet.")
+
+    st.header("Slow operations")
+    slow = list(registry.slow_ops)[::-1]
+    if slow:
+        st.dataframe([dict(s, shape=str(s["shape"])) for s in slow], use_container_width=True)
+    else:
+        st.write("No slow operations.")
+
+    st.header("Export")
+    text = registry.prometheus_text()
+    st.download_button("Download metrics (Prometheus text)", data=text, file_name="metrics.txt", mime="text/plain")
+    with st.expander("Show metrics"):
+        st.code(text, language="text")
+    if st.button("Reset metrics"):
+        registry.reset()
+        st.rerun()
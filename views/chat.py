@@ -1,19 +1,336 @@
 import streamlit as st, io
 from database import (
     get_private_conversation, get_group_conversation,
-    create_message, store_file, get_file,
-    get_user_groups, delete_message, edit_message,
-    mark_messages_read, search_messages, add_reaction, get_user,
-    get_new_private_messages, get_new_group_messages
+    create_message, store_file, get_file, get_file_meta, get_thumbnail,
+    delete_message, edit_message,
+    mark_messages_read, search_messages, toggle_reaction, get_users_by_names, REACTIONS,
+    get_conversation_changes, SYNC_BATCH, conversation_key,
+    list_conversations, find_users, mark_group_read
 )
+from live import hub
+from records import Message, to_ms
+from context import current_request
+from metrics import registry as metrics_registry
+from bson import ObjectId
 import emoji
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# How long an idle page waits for new messages before rerunning anyway
+LIVE_WAIT_SECONDS = 30
+# Newest messages rendered with full widgets; older ones are static markdown
+RENDER_WINDOW = 20
+# Shorter queries are not sent to the server
+SEARCH_MIN_CHARS = 2
+
+def _sender_profiles(messages):
+    # One cached/batched lookup for every sender on the page
+    try:
+        return get_users_by_names(m.sender for m in messages)
+    except Exception as e:
+        logging.error(f"Error fetching users: {e}")
+        st.error(f"Error fetching users: {e}")
+        return {}
+
+def _human_size(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def _render_attachment(file_id):
+    # Metadata decides how to show the file; content is only read for images
+    # and for downloads the user explicitly asked for
+    try:
+        meta = get_file_meta(file_id)
+        if meta is None:
+            st.caption("Attachment unavailable")
+            return
+        if meta["mime"] == "application/pdf":
+            st.write(f"📄 PDF Attachment ({_human_size(meta['size'])})")
+        else:
+            expanded = st.session_state.setdefault("expanded_images", set())
+            if file_id in expanded:
+                st.image(get_file(file_id)["content"])
+            else:
+                thumb = get_thumbnail(file_id)
+                if thumb:
+                    st.image(thumb)
+                else:
+                    st.write(f"🖼️ {meta['name']} ({_human_size(meta['size'])})")
+                if st.button("View full size", key=f"expand_{file_id}"):
+                    expanded.add(file_id)
+                    st.rerun()
+        ready = st.session_state.setdefault("download_ready", set())
+        if file_id in ready:
+            fdoc = get_file(file_id)
+            st.download_button(
+                label=f"Download {meta['name']}",
+                data=fdoc["content"],
+                file_name=meta["name"],
+                mime=meta["mime"],
+                key=f"download_{file_id}"
+            )
+        elif st.button("Download", key=f"prepare_download_{file_id}"):
+            ready.add(file_id)
+            st.rerun()
+    except Exception as e:
+        logging.error(f"Error fetching file: {e}")
+        st.error(f"Error fetching file: {e}")
+
+def _patch_cached(message_id, **fields):
+    # Update one cached message instead of refetching the page.  Records may
+    # be shared with other sessions through the room cache, so copy, not mutate.
+    cached = st.session_state.cached_messages
+    for i, m in enumerate(cached):
+        if m.id == message_id:
+            cached[i] = m.replace(**fields)
+            return
+
+def _render_reactions(m, u):
+    counts = m.reactions or {}
+    reactors = m.reactors or {}
+    cols = st.columns(len(REACTIONS) + 3)
+    for col, r in zip(cols, REACTIONS):
+        n = counts.get(r, 0)
+        with col:
+            if st.button(f"{r} {n}" if n > 0 else r, key=f"react_{r}_{m.id}",
+                         type="primary" if u in reactors.get(r, []) else "secondary"):
+                try:
+                    updated = toggle_reaction(str(m.id), u, r)
+                    if updated:
+                        _patch_cached(m.id, **Message.reaction_fields(updated))
+                    st.rerun()
+                except Exception as e:
+                    logging.error(f"Error adding reaction: {e}")
+                    st.error(f"Error adding reaction: {e}")
+
+def _apply_changes(changes):
+    # Merge message changes into the cache in place: replace by _id, drop
+    # tombstones, append new messages (skipping ones older than the loaded page)
+    cached = st.session_state.cached_messages
+    index = {m.id: i for i, m in enumerate(cached)}
+    oldest = cached[0].ts if cached else None
+    appended = False
+    for msg in changes:
+        i = index.get(msg.id)
+        if i is not None:
+            cached[i] = None if msg.deleted else msg
+        elif not msg.deleted and (oldest is None or msg.ts >= oldest):
+            index[msg.id] = len(cached)
+            cached.append(msg)
+            appended = True
+    cached = [m for m in cached if m is not None]
+    if appended:
+        cached.sort(key=lambda m: m.sort_key)
+    st.session_state.cached_messages = cached
+
+def _render_message(m, u, profiles, show_status):
+    # Full interactive rendering: attachment widgets, reactions, edit/delete
+    with st.chat_message("user" if m.sender == u else "assistant"):
+        sender_display = (profiles.get(m.sender) or {}).get("display_name", m.sender)
+        st.markdown(f"**{sender_display}**")
+        if st.session_state.editing_message_id == str(m.id):
+            # Editing mode
+            if m.file_id:
+                _render_attachment(m.file_id)
+            new_content = st.text_input("Edit message", value=m.content, key=f"edit_{m.id}")
+            if st.button("Save", key=f"save_{m.id}"):
+                try:
+                    updated = edit_message(str(m.id), u, new_content)
+                    st.session_state.editing_message_id = None
+                    if updated:
+                        _apply_changes([Message.from_doc(updated)])
+                    st.rerun()
+                except Exception as e:
+                    logging.error(f"Error editing message: {e}")
+                    st.error(f"Error editing message: {e}")
+            return
+        # Normal display
+        if m.edited:
+            st.markdown("*(Edited)*")
+        st.write(emoji.emojize(m.content))
+        st.markdown(f"<small>{m.timestamp.strftime('%Y-%m-%d %H:%M:%S')}</small>", unsafe_allow_html=True)
+        if m.file_id:
+            _render_attachment(m.file_id)
+        if m.archived:
+            # Archived messages are read-only: no reactions, edits or deletes
+            if m.reactions:
+                st.markdown(" ".join(f"{r} {n}" for r, n in m.reactions.items()))
+            st.caption("Archived")
+            return
+        _render_reactions(m, u)
+        if m.sender == u:
+            if show_status:
+                status = "Read" if m.read else "Sent"
+                st.markdown(f"<small>*{status}*</small>", unsafe_allow_html=True)
+            col1, col2, _ = st.columns([1, 1, 2])
+            with col1:
+                if st.button("Edit", key=f"edit_btn_{m.id}"):
+                    st.session_state.editing_message_id = str(m.id)
+                    st.rerun()
+            with col2:
+                if st.button("Delete", key=f"delete_btn_{m.id}"):
+                    try:
+                        tombstone = delete_message(str(m.id), u)
+                        if tombstone:
+                            _apply_changes([Message.from_doc(tombstone)])
+                        st.rerun()
+                    except Exception as e:
+                        logging.error(f"Error deleting message: {e}")
+                        st.error(f"Error deleting message: {e}")
+
+def _static_markdown(m, u, profiles):
+    # Widget-free rendering for messages outside the live window
+    name = "You" if m.sender == u else (profiles.get(m.sender) or {}).get("display_name", m.sender)
+    meta = m.timestamp.strftime('%Y-%m-%d %H:%M')
+    if m.edited:
+        meta += " · edited"
+    lines = [f"**{name}** · *{meta}*", emoji.emojize(m.content)]
+    if m.file_id:
+        lines.append("📎 *attachment*")
+    if m.reactions:
+        lines.append(" ".join(f"{r} {n}" for r, n in m.reactions.items()))
+    return "  \n".join(lines)
+
+def _render_messages(messages, u, show_status):
+    # Only the newest `render_window` messages get widgets; older ones are a
+    # single static markdown block.  Render time goes to the admin caption and
+    # the metrics registry.
+    started = time.perf_counter()
+    window = st.session_state.render_window
+    profiles = _sender_profiles(messages)
+    older, live = messages[:-window] if len(messages) > window else [], messages[-window:]
+    if older:
+        with st.container(border=True):
+            st.markdown("\n\n---\n\n".join(_static_markdown(m, u, profiles) for m in older))
+        if st.button(f"Show actions for {min(RENDER_WINDOW, len(older))} earlier messages", key="expand_render_window"):
+            st.session_state.render_window += RENDER_WINDOW
+            st.rerun()
+    for m in live:
+        _render_message(m, u, profiles, show_status)
+    ms = (time.perf_counter() - started) * 1000
+    metrics_registry.record_call("view.render_messages", ms, False)
+    current_request().record_timing("messages", ms, f"{len(live)} live / {len(older)} static")
+
+def _search_params(scope, key_prefix):
+    # Filter widgets; returns search_messages keyword arguments
+    with st.expander("Search filters"):
+        everywhere = st.checkbox("Search all my conversations", key=f"search_all_{key_prefix}")
+        sender = st.text_input("From user", key=f"search_sender_{key_prefix}").strip()
+        col1, col2 = st.columns(2)
+        since = col1.date_input("From date", value=None, key=f"search_since_{key_prefix}")
+        until = col2.date_input("To date", value=None, key=f"search_until_{key_prefix}")
+        attachments = st.radio("Attachments", ["Any", "With", "Without"], horizontal=True, key=f"search_files_{key_prefix}")
+    return dict(
+        {} if everywhere else scope,
+        sender=sender or None,
+        since=datetime.combine(since, datetime.min.time()) if since else None,
+        until=datetime.combine(until, datetime.min.time()) + timedelta(days=1) if until else None,
+        has_file={"Any": None, "With": True, "Without": False}[attachments],
+    )
+
+def _search_panel(u, scope, key_prefix):
+    # Search box for the open chat; returns True while results are shown.
+    # Results are kept in session state per query and filters, so live-update
+    # reruns and button clicks reuse them instead of searching again.
+    query = st.text_input("Search messages", key=f"search_input_{key_prefix}", placeholder="🔍 Type to search...").strip()
+    if len(query) < SEARCH_MIN_CHARS:
+        if query:
+            st.caption(f"Type at least {SEARCH_MIN_CHARS} characters to search.")
+        return False
+    params = _search_params(scope, key_prefix)
+    search_key = (query, tuple(sorted(params.items())))
+    state = st.session_state.get("search_state")
+    try:
+        if state is None or state["key"] != search_key:
+            results, cursor = search_messages(query, u, **params)
+            state = st.session_state.search_state = {"key": search_key, "results": results, "cursor": cursor}
+        profiles = get_users_by_names(d["sender"] for d in state["results"])
+    except Exception as e:
+        logging.error(f"Error searching messages: {e}")
+        st.error(f"Error searching messages: {e}")
+        return True
+
+    if not state["results"]:
+        st.info("No messages found.")
+    for d in state["results"]:
+        name = (profiles.get(d["sender"]) or {}).get("display_name", d["sender"])
+        where = f"#{d['group']}" if d.get("group") else f"@{d['receiver'] if d['sender'] == u else d['sender']}"
+        attachment = " · 📎" if d.get("file_id") else ""
+        st.markdown(f"**{name}** · {where} · *{d['timestamp']:%Y-%m-%d %H:%M}*{attachment}  \n"
+                    f"{emoji.emojize(d['snippet'])}")
+    if state["cursor"] and st.button("More results", key=f"search_more_{key_prefix}"):
+        try:
+            more, state["cursor"] = search_messages(query, u, cursor=state["cursor"], **params)
+            state["results"].extend(more)
+            st.rerun()
+        except Exception as e:
+            logging.error(f"Error searching messages: {e}")
+            st.error(f"Error searching messages: {e}")
+    return True
+
+def _as_records(page):
+    docs, cursor = page
+    return Message.from_docs(docs), cursor
+
+def _load_conversation(key, loader):
+    # Take the live cursor before loading so nothing posted in between is lost
+    st.session_state.live_cursor = (key, hub.cursor(key))
+    st.session_state.cached_messages, st.session_state.history_cursor = loader()
+    if st.session_state.cached_messages:
+        st.session_state.sync_watermark = max(m.updated_at for m in st.session_state.cached_messages)
+
+def _load_older(loader):
+    # Prepend the next older page to what is already cached
+    try:
+        older, st.session_state.history_cursor = loader(st.session_state.history_cursor)
+        st.session_state.cached_messages = Message.from_docs(older) + st.session_state.cached_messages
+        st.rerun()
+    except Exception as e:
+        logging.error(f"Error loading older messages: {e}")
+        st.error(f"Error loading older messages: {e}")
+
+def _pull_changes(key):
+    # Changes come from the in-process live hub; the DB is only asked for a
+    # delta since the sync watermark when this session fell behind the buffer.
+    # Returns False when the delta filled a whole batch: more may follow, and
+    # reloading the conversation is cheaper than paging through them.
+    cur_key, seq = st.session_state.live_cursor
+    changes = None
+    if cur_key == key:
+        changes, seq = hub.poll(key, seq)
+    if changes is None:
+        seq = hub.cursor(key)
+        changes = Message.from_docs(get_conversation_changes(key, st.session_state.sync_watermark, limit=SYNC_BATCH))
+        if len(changes) >= SYNC_BATCH:
+            return False
+    st.session_state.live_cursor = (key, seq)
+    if changes:
+        _apply_changes(changes)
+        st.session_state.sync_watermark = max(st.session_state.sync_watermark, max(m.updated_at for m in changes))
+    return True
+
+def _wait_for_updates(key):
+    # Hold the script until this conversation has new data, then rerun.
+    # Touching the placeholder each second lets Streamlit interrupt the wait
+    # as soon as the user interacts with the page.
+    if not st.session_state.auto_refresh or st.session_state.is_sending:
+        return
+    current_request().publish()
+    heartbeat = st.empty()
+    deadline = time.time() + LIVE_WAIT_SECONDS
+    while time.time() < deadline:
+        if hub.wait(key, st.session_state.live_cursor[1], timeout=1.0):
+            break
+        heartbeat.empty()
+    st.rerun()
+
 def show_chat():
     u = st.session_state.username
     display_name = st.session_state.display_name or u
@@ -27,41 +344,25 @@ def show_chat():
         st.session_state.chat_partner = None
     if "chat_group" not in st.session_state:
         st.session_state.chat_group = None
-    if "message_offset" not in st.session_state:
-        st.session_state.message_offset = 0
+    if "history_cursor" not in st.session_state:
+        st.session_state.history_cursor = None
     if "editing_message_id" not in st.session_state:
         st.session_state.editing_message_id = None
-    if "all_users" not in st.session_state:
-        try:
-            st.session_state.all_users = [doc["username"] for doc in __import__("database").users_coll.find({"username": {"$ne": u}})]
-        except Exception as e:
-            logging.error(f"Error fetching users: {e}")
-            st.error(f"Error fetching users: {e}")
-            st.session_state.all_users = []
     if "chatted_users" not in st.session_state:
+        # Chats started this session that have no messages yet
         st.session_state.chatted_users = set()
-        try:
-            messages = __import__("database").messages_coll.find({
-                "$or": [{"sender": u}, {"receiver": u}]
-            })
-            for msg in messages:
-                if msg["sender"] != u:
-                    st.session_state.chatted_users.add(msg["sender"])
-                if msg.get("receiver") and msg["receiver"] != u:
-                    st.session_state.chatted_users.add(msg["receiver"])
-        except Exception as e:
-            logging.error(f"Error fetching chatted users: {e}")
-            st.error(f"Error fetching chatted users: {e}")
-    if "last_message_time" not in st.session_state:
-        st.session_state.last_message_time = datetime.utcnow()
+    if "sync_watermark" not in st.session_state:
+        st.session_state.sync_watermark = datetime.utcnow()
     if "cached_messages" not in st.session_state:
         st.session_state.cached_messages = []
     if "auto_refresh" not in st.session_state:
         st.session_state.auto_refresh = True
-    if "last_refresh" not in st.session_state:
-        st.session_state.last_refresh = time.time()
+    if "live_cursor" not in st.session_state:
+        st.session_state.live_cursor = (None, 0)
     if "is_sending" not in st.session_state:
         st.session_state.is_sending = False
+    if "render_window" not in st.session_state:
+        st.session_state.render_window = RENDER_WINDOW
 
     # Secondary sidebar for chat selection
     with st.sidebar:
@@ -94,22 +395,39 @@ def show_chat():
         </style>
         """, unsafe_allow_html=True)
         
-        # Show users with existing chats
+        # Show users with existing chats, most recent first
         st.markdown("**Private**")
-        for other in sorted(st.session_state.chatted_users):
-            if st.button(other, key=f"chat_user_{other}", help=f"Chat with {other}", use_container_width=True):
+        try:
+            conversations = list_conversations(u)
+        except Exception as e:
+            logging.error(f"Error fetching chatted users: {e}")
+            st.error(f"Error fetching chatted users: {e}")
+            conversations = []
+        known = {c["partner"] for c in conversations}
+        entries = [(c["partner"], c.get("unread_count", 0)) for c in conversations]
+        entries += [(other, 0) for other in sorted(st.session_state.chatted_users - known)]
+        for other, unread in entries:
+            label = f"{other} ({unread})" if unread else other
+            if st.button(label, key=f"chat_user_{other}", help=f"Chat with {other}", use_container_width=True):
                 st.session_state.chat_mode = "private"
                 st.session_state.chat_partner = other
-                st.session_state.message_offset = 0
+                st.session_state.history_cursor = None
                 st.session_state.editing_message_id = None
+                st.session_state.render_window = RENDER_WINDOW
                 st.session_state.cached_messages = []
-                st.session_state.last_message_time = datetime.utcnow()
+                st.session_state.sync_watermark = datetime.utcnow()
                 st.session_state.is_sending = False
                 st.rerun()
 
         # Dropdown for new chats with confirmation button
         st.markdown("**Start New Chat**")
-        new_users = [user for user in st.session_state.all_users if user not in st.session_state.chatted_users]
+        prefix = st.text_input("Find user", key="new_chat_prefix", placeholder="Username starts with…")
+        try:
+            new_users = [user for user in find_users(prefix, exclude=u) if user not in known]
+        except Exception as e:
+            logging.error(f"Error fetching users: {e}")
+            st.error(f"Error fetching users: {e}")
+            new_users = []
         if not new_users:
             st.info("No new users to chat with.")
         else:
@@ -117,10 +435,11 @@ def show_chat():
             if new_user and st.button("Start Chat", key="start_new_chat"):
                 st.session_state.chat_mode = "private"
                 st.session_state.chat_partner = new_user
-                st.session_state.message_offset = 0
+                st.session_state.history_cursor = None
                 st.session_state.editing_message_id = None
+                st.session_state.render_window = RENDER_WINDOW
                 st.session_state.cached_messages = []
-                st.session_state.last_message_time = datetime.utcnow()
+                st.session_state.sync_watermark = datetime.utcnow()
                 st.session_state.chatted_users.add(new_user)
                 st.session_state.is_sending = False
                 st.rerun()
@@ -128,14 +447,15 @@ def show_chat():
         # Group chats
         st.markdown("**Groups**")
         try:
-            for grp in get_user_groups(u):
+            for grp in current_request().get_user_groups(u):
                 if st.button(grp["name"], key=f"chat_group_{grp['name']}", help=f"Join {grp['name']}", use_container_width=True):
                     st.session_state.chat_mode = "group"
                     st.session_state.chat_group = grp["name"]
-                    st.session_state.message_offset = 0
+                    st.session_state.history_cursor = None
                     st.session_state.editing_message_id = None
+                    st.session_state.render_window = RENDER_WINDOW
                     st.session_state.cached_messages = []
-                    st.session_state.last_message_time = datetime.utcnow()
+                    st.session_state.sync_watermark = datetime.utcnow()
                     st.session_state.is_sending = False
                     st.rerun()
         except Exception as e:
@@ -144,14 +464,9 @@ def show_chat():
 
     mode = st.session_state.chat_mode
 
-    # Auto-refresh logic (paused during sending)
+    # Live updates (paused during sending); see _wait_for_updates
     st.checkbox("Enable Auto-Refresh", value=st.session_state.auto_refresh, key="auto_refresh_toggle")
     st.session_state.auto_refresh = st.session_state.auto_refresh_toggle
-    if (st.session_state.auto_refresh and 
-        not st.session_state.is_sending and 
-        time.time() - st.session_state.last_refresh >= 5):
-        st.session_state.last_refresh = time.time()
-        st.rerun()
 
     if mode == "private":
         p = st.session_state.chat_partner
@@ -168,142 +483,31 @@ def show_chat():
         # Refresh button
         if st.button("Refresh Chat", key="refresh_private_chat"):
             st.session_state.cached_messages = []
-            st.session_state.last_message_time = datetime.utcnow()
+            st.session_state.sync_watermark = datetime.utcnow()
             st.session_state.is_sending = False
             st.rerun()
 
-        search_query = st.text_input("Search messages", key="search_input_private", placeholder="🔍 Type to search...")
-        try:
-            if search_query:
-                messages = search_messages(search_query, u, p=p)
-                st.session_state.cached_messages = messages
-                st.session_state.last_message_time = datetime.utcnow() if not messages else max(m["timestamp"] for m in messages)
-            else:
-                # Fetch new messages since last timestamp
-                new_messages = get_new_private_messages(u, p, st.session_state.last_message_time)
-                if new_messages:
-                    st.session_state.cached_messages.extend(new_messages)
-                    st.session_state.last_message_time = max(m["timestamp"] for m in new_messages)
-                # Fetch initial messages if cache is empty
-                if not st.session_state.cached_messages:
-                    st.session_state.cached_messages = get_private_conversation(u, p, skip=st.session_state.message_offset, limit=50)
-                    if st.session_state.cached_messages:
-                        st.session_state.last_message_time = max(m["timestamp"] for m in st.session_state.cached_messages)
+        key = conversation_key(u, p)
+        searching = _search_panel(u, {"p": p}, "private")
+        if not searching:
+            try:
+                # Apply whatever changed since the last run, or (re)load
+                if not (st.session_state.cached_messages and _pull_changes(key)):
+                    _load_conversation(key, lambda: _as_records(get_private_conversation(u, p, limit=50)))
                 messages = st.session_state.cached_messages
-        except Exception as e:
-            logging.error(f"Error fetching messages: {e}")
-            st.error(f"Error fetching messages: {e}")
-            messages = []
+            except Exception as e:
+                logging.error(f"Error fetching messages: {e}")
+                st.error(f"Error fetching messages: {e}")
+                messages = []
 
-        if not messages:
-            st.info(f"Start your conversation with {p}!")
-        else:
-            for m in messages:
-                with st.chat_message("user" if m["sender"] == u else "assistant"):
-                    try:
-                        sender_display = get_user(m["sender"])["profile"].get("display_name", m["sender"])
-                    except Exception as e:
-                        logging.error(f"Error fetching user: {e}")
-                        st.error(f"Error fetching user: {e}")
-                        sender_display = m["sender"]
-                    st.markdown(f"**{sender_display}**")
-                    if st.session_state.editing_message_id == str(m["_id"]):
-                        # Editing mode
-                        if m.get("file_id"):
-                            try:
-                                fdoc = get_file(m["file_id"])
-                                if fdoc["name"].lower().endswith(".pdf"):
-                                    st.write("📄 PDF Attachment")
-                                    st.download_button(
-                                        label="Download PDF",
-                                        data=fdoc["content"],
-                                        file_name=fdoc["name"],
-                                        mime="application/pdf"
-                                    )
-                                else:
-                                    st.image(fdoc["content"])
-                                    st.download_button(
-                                        label="Download Image",
-                                        data=fdoc["content"],
-                                        file_name=fdoc["name"],
-                                        mime="image/jpeg"
-                                    )
-                            except Exception as e:
-                                logging.error(f"Error fetching file: {e}")
-                                st.error(f"Error fetching file: {e}")
-                        new_content = st.text_input("Edit message", value=m["content"], key=f"edit_{m['_id']}")
-                        if st.button("Save", key=f"save_{m['_id']}"):
-                            try:
-                                edit_message(str(m["_id"]), u, new_content)
-                                st.session_state.editing_message_id = None
-                                st.session_state.cached_messages = []
-                                st.rerun()
-                            except Exception as e:
-                                logging.error(f"Error editing message: {e}")
-                                st.error(f"Error editing message: {e}")
-                    else:
-                        # Normal display
-                        if m.get("edited", False):
-                            st.markdown("*(Edited)*")
-                        st.write(emoji.emojize(m["content"]))
-                        st.markdown(f"<small>{m['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}</small>", unsafe_allow_html=True)
-                        if m.get("file_id"):
-                            try:
-                                fdoc = get_file(m["file_id"])
-                                if fdoc["name"].lower().endswith(".pdf"):
-                                    st.write("📄 PDF Attachment")
-                                    st.download_button(
-                                        label="Download PDF",
-                                        data=fdoc["content"],
-                                        file_name=fdoc["name"],
-                                        mime="application/pdf"
-                                    )
-                                else:
-                                    st.image(fdoc["content"])
-                                    st.download_button(
-                                        label="Download Image",
-                                        data=fdoc["content"],
-                                        file_name=fdoc["name"],
-                                        mime="image/jpeg"
-                                    )
-                            except Exception as e:
-                                logging.error(f"Error fetching file: {e}")
-                                st.error(f"Error fetching file: {e}")
-                        if m.get("reactions"):
-                            st.markdown(" ".join(f"{r} {c}" for r, c in m["reactions"].items()))
-                        if m["sender"] == u:
-                            status = "Read" if m.get("read", False) else "Sent"
-                            st.markdown(f"<small>*{status}*</small>", unsafe_allow_html=True)
-                            col1, col2, col3 = st.columns([1, 1, 2])
-                            with col1:
-                                if st.button("Edit", key=f"edit_btn_{m['_id']}"):
-                                    st.session_state.editing_message_id = str(m["_id"])
-                                    st.rerun()
-                            with col2:
-                                if st.button("Delete", key=f"delete_btn_{m['_id']}"):
-                                    try:
-                                        delete_message(str(m["_id"]), u)
-                                        st.session_state.cached_messages = []
-                                        st.rerun()
-                                    except Exception as e:
-                                        logging.error(f"Error deleting message: {e}")
-                                        st.error(f"Error deleting message: {e}")
-                            with col3:
-                                reaction = st.selectbox("React", ["", "👍", "❤️", "😂"], key=f"react_{m['_id']}")
-                                if reaction:
-                                    try:
-                                        add_reaction(str(m["_id"]), u, reaction)
-                                        st.session_state.cached_messages = []
-                                        st.rerun()
-                                    except Exception as e:
-                                        logging.error(f"Error adding reaction: {e}")
-                                        st.error(f"Error adding reaction: {e}")
-
-        if not search_query and len(messages) == 50:
-            if st.button("Load More", key="load_more_private"):
-                st.session_state.message_offset += 50
-                st.session_state.cached_messages = []
-                st.rerun()
+            if not messages:
+                st.info(f"Start your conversation with {p}!")
+            else:
+                _render_messages(messages, u, show_status=True)
+
+            if st.session_state.history_cursor:
+                if st.button("Load More", key="load_more_private"):
+                    _load_older(lambda c: get_private_conversation(u, p, cursor=c, limit=50))
 
         txt = st.chat_input("Send a private message…")
         up = st.file_uploader("Attachment", type=["png","jpg","jpeg","pdf"], key="private_upload")
@@ -314,21 +518,10 @@ def show_chat():
                 if up:
                     fid = store_file(io.BytesIO(up.getvalue()), up.name)
                 # Create message
-                create_message(u, receiver=p, content=txt if txt is not None else "", file_id=fid)
+                mid = create_message(u, receiver=p, content=txt if txt is not None else "", file_id=fid)
                 # Append new message to cache
-                new_msg = {
-                    "sender": u,
-                    "receiver": p,
-                    "content": txt if txt is not None else "",
-                    "timestamp": datetime.utcnow(),
-                    "file_id": fid,
-                    "read": False,
-                    "reactions": {}
-                }
+                new_msg = Message(ObjectId(mid), u, txt if txt is not None else "", to_ms(datetime.utcnow()), file_id=fid)
                 st.session_state.cached_messages.append(new_msg)
-                st.session_state.last_message_time = new_msg["timestamp"]
-                if p not in st.session_state.chatted_users:
-                    st.session_state.chatted_users.add(p)
                 st.session_state.is_sending = False
                 st.rerun()
             except Exception as e:
@@ -336,146 +529,49 @@ def show_chat():
                 logging.error(f"Error sending message: {e}")
                 st.error(f"Failed to send message: {e}")
 
+        if not searching:
+            _wait_for_updates(key)
+
     else:  # Group mode
         g = st.session_state.chat_group
         if not g:
             st.info("Select a group from the sidebar to start chatting")
             return
 
+        try:
+            mark_group_read(u, g)
+        except Exception as e:
+            logging.error(f"Error marking messages read: {e}")
+            st.error(f"Error marking messages read: {e}")
+
         # Refresh button
         if st.button("Refresh Chat", key="refresh_group_chat"):
+            # Reload the shared room too, in case it drifted from the database
+            hub.rooms.invalidate(conversation_key(group=g))
             st.session_state.cached_messages = []
-            st.session_state.last_message_time = datetime.utcnow()
+            st.session_state.sync_watermark = datetime.utcnow()
             st.session_state.is_sending = False
             st.rerun()
 
-        search_query = st.text_input("Search messages", key="search_input_group", placeholder="🔍 Type to search...")
-        try:
-            if search_query:
-                messages = search_messages(search_query, u, g=g)
-                st.session_state.cached_messages = messages
-                st.session_state.last_message_time = datetime.utcnow() if not messages else max(m["timestamp"] for m in messages)
-            else:
-                # Fetch new messages since last timestamp
-                new_messages = get_new_group_messages(g, st.session_state.last_message_time)
-                if new_messages:
-                    st.session_state.cached_messages.extend(new_messages)
-                    st.session_state.last_message_time = max(m["timestamp"] for m in new_messages)
-                # Fetch initial messages if cache is empty
-                if not st.session_state.cached_messages:
-                    st.session_state.cached_messages = get_group_conversation(g, skip=st.session_state.message_offset, limit=50)
-                    if st.session_state.cached_messages:
-                        st.session_state.last_message_time = max(m["timestamp"] for m in st.session_state.cached_messages)
+        key = conversation_key(group=g)
+        searching = _search_panel(u, {"g": g}, "group")
+        if not searching:
+            try:
+                # Apply whatever changed since the last run, or (re)load;
+                # busy rooms are served from the process-wide room cache
+                if not (st.session_state.cached_messages and _pull_changes(key)):
+                    _load_conversation(key, lambda: hub.recent(key, lambda n: get_group_conversation(g, limit=n), 50))
                 messages = st.session_state.cached_messages
-        except Exception as e:
-            logging.error(f"Error fetching messages: {e}")
-            st.error(f"Error fetching messages: {e}")
-            messages = []
+            except Exception as e:
+                logging.error(f"Error fetching messages: {e}")
+                st.error(f"Error fetching messages: {e}")
+                messages = []
 
-        for m in messages:
-            with st.chat_message("user" if m["sender"] == u else "assistant"):
-                try:
-                    sender_display = get_user(m["sender"])["profile"].get("display_name", m["sender"])
-                except Exception as e:
-                    logging.error(f"Error fetching user: {e}")
-                    st.error(f"Error fetching user: {e}")
-                    sender_display = m["sender"]
-                st.markdown(f"**{sender_display}**")
-                if st.session_state.editing_message_id == str(m["_id"]):
-                    # Editing mode
-                    if m.get("file_id"):
-                        try:
-                            fdoc = get_file(m["file_id"])
-                            if fdoc["name"].lower().endswith(".pdf"):
-                                st.write("📄 PDF Attachment")
-                                st.download_button(
-                                    label="Download PDF",
-                                    data=fdoc["content"],
-                                    file_name=fdoc["name"],
-                                    mime="application/pdf"
-                                )
-                            else:
-                                st.image(fdoc["content"])
-                                st.download_button(
-                                    label="Download Image",
-                                    data=fdoc["content"],
-                                    file_name=fdoc["name"],
-                                    mime="image/jpeg"
-                                )
-                        except Exception as e:
-                            logging.error(f"Error fetching file: {e}")
-                            st.error(f"Error fetching file: {e}")
-                    new_content = st.text_input("Edit message", value=m["content"], key=f"edit_{m['_id']}")
-                    if st.button("Save", key=f"save_{m['_id']}"):
-                        try:
-                            edit_message(str(m["_id"]), u, new_content)
-                            st.session_state.editing_message_id = None
-                            st.session_state.cached_messages = []
-                            st.rerun()
-                        except Exception as e:
-                            logging.error(f"Error editing message: {e}")
-                            st.error(f"Error editing message: {e}")
-                else:
-                    # Normal display
-                    if m.get("edited", False):
-                        st.markdown("*(Edited)*")
-                    st.write(emoji.emojize(m["content"]))
-                    st.markdown(f"<small>{m['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}</small>", unsafe_allow_html=True)
-                    if m.get("file_id"):
-                        try:
-                            fdoc = get_file(m["file_id"])
-                            if fdoc["name"].lower().endswith(".pdf"):
-                                st.write("📄 PDF Attachment")
-                                st.download_button(
-                                    label="Download PDF",
-                                    data=fdoc["content"],
-                                    file_name=fdoc["name"],
-                                    mime="application/pdf"
-                                )
-                            else:
-                                st.image(fdoc["content"])
-                                st.download_button(
-                                    label="Download Image",
-                                    data=fdoc["content"],
-                                    file_name=fdoc["name"],
-                                    mime="image/jpeg"
-                                )
-                        except Exception as e:
-                            logging.error(f"Error fetching file: {e}")
-                            st.error(f"Error fetching file: {e}")
-                    if m.get("reactions"):
-                        st.markdown(" ".join(f"{r} {c}" for r, c in m["reactions"].items()))
-                    if m["sender"] == u:
-                        col1, col2, col3 = st.columns([1, 1, 2])
-                        with col1:
-                            if st.button("Edit", key=f"edit_btn_{m['_id']}"):
-                                st.session_state.editing_message_id = str(m["_id"])
-                                st.rerun()
-                        with col2:
-                            if st.button("Delete", key=f"delete_btn_{m['_id']}"):
-                                try:
-                                    delete_message(str(m["_id"]), u)
-                                    st.session_state.cached_messages = []
-                                    st.rerun()
-                                except Exception as e:
-                                    logging.error(f"Error deleting message: {e}")
-                                    st.error(f"Error deleting message: {e}")
-                        with col3:
-                            reaction = st.selectbox("React", ["", "👍", "❤️", "😂"], key=f"react_{m['_id']}")
-                            if reaction:
-                                try:
-                                    add_reaction(str(m["_id"]), u, reaction)
-                                    st.session_state.cached_messages = []
-                                    st.rerun()
-                                except Exception as e:
-                                    logging.error(f"Error adding reaction: {e}")
-                                    st.error(f"Error adding reaction: {e}")
-
-        if not search_query and len(messages) == 50:
-            if st.button("Load More", key="load_more_group"):
-                st.session_state.message_offset += 50
-                st.session_state.cached_messages = []
-                st.rerun()
+            _render_messages(messages, u, show_status=False)
+
+            if st.session_state.history_cursor:
+                if st.button("Load More", key="load_more_group"):
+                    _load_older(lambda c: get_group_conversation(g, cursor=c, limit=50))
 
         txt = st.chat_input("Send a group message…")
         up = st.file_uploader("Attachment", type=["png","jpg","jpeg","pdf"], key="group_upload")
@@ -486,22 +582,16 @@ def show_chat():
                 if up:
                     fid = store_file(io.BytesIO(up.getvalue()), up.name)
                 # Create message
-                create_message(u, group=g, content=txt if txt is not None else "", file_id=fid)
+                mid = create_message(u, group=g, content=txt if txt is not None else "", file_id=fid)
                 # Append new message to cache
-                new_msg = {
-                    "sender": u,
-                    "group": g,
-                    "content": txt if txt is not None else "",
-                    "timestamp": datetime.utcnow(),
-                    "file_id": fid,
-                    "read": False,
-                    "reactions": {}
-                }
+                new_msg = Message(ObjectId(mid), u, txt if txt is not None else "", to_ms(datetime.utcnow()), file_id=fid)
                 st.session_state.cached_messages.append(new_msg)
-                st.session_state.last_message_time = new_msg["timestamp"]
                 st.session_state.is_sending = False
                 st.rerun()
             except Exception as e:
                 st.session_state.is_sending = False
                 logging.error(f"Error sending group message: {e}")
-                st.error(f"Failed to send group message: {e}")
\ No newline at end of file
+                st.error(f"Failed to send group message: {e}")
+
+        if not searching:
+            _wait_for_updates(key)
\ No newline at end of file
@@ -1,12 +1,13 @@
 import streamlit as st
-from database import list_rooms, create_group, invite_user_to_group, get_user_invites, accept_invite
+from database import create_group, invite_user_to_group, get_user_invites, accept_invite
+from context import current_request
 
 def show_groups():
     st.title("Groups")
     username = st.session_state.username
     
     st.subheader("Your Groups")
-    for room in list_rooms(username):
+    for room in current_request().list_rooms(username):
         st.write(f"{room['name']} {'(Public)' if room['is_public'] else ''}")
     
     st.subheader("Create Group")
@@ -1,14 +1,19 @@
 import streamlit as st
-from database import get_user, get_notifications, mark_notifications_read, get_file, list_rooms
+from database import mark_notifications_read, get_file
+from context import current_request
+
+ACTIVITY_LIMIT = 20
 
 def show_home():
     u = st.session_state.username
+    ctx = current_request()
     st.title(f"Welcome to Big Boss Chat, {u}!")
 
-    nots = get_notifications(u)
+    # Latest unread notifications for the activity feed; the badge uses the counter
+    nots = ctx.get_notifications(u, ACTIVITY_LIMIT)
     _, bell = st.columns([9, 1])
     with bell:
-        if st.button(f"🔔 {len(nots)}", key="notification_bell"):
+        if st.button(f"🔔 {ctx.get_unread_count(u)}", key="notification_bell"):
             for n in nots:
                 st.write(f"🎉 From **{n['msg']['sender']}** at {n['ts']}")
             mark_notifications_read(u)
@@ -28,7 +33,7 @@ def show_home():
         st.write("No new activity.")
 
     st.header("Your Rooms")
-    rooms = list_rooms(u)
+    rooms = ctx.list_rooms(u)
     if rooms:
         for r in rooms:
             st.write(f"• {r['name']}")
@@ -36,7 +41,7 @@ def show_home():
         st.write("You're not in any rooms yet.")
 
     st.header("Profile Summary")
-    user = get_user(u)
+    user = ctx.get_user(u)
     prof = user["profile"]
     st.write(f"**Name:** {prof.get('name', u)}")
     if prof.get("show_bio"):
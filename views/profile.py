@@ -1,11 +1,13 @@
 import streamlit as st
-from database import get_user, update_profile, delete_user
+from database import update_profile, delete_user
+from context import current_request
 from auth import logout
 
 def show_profile():
     st.title("Profile Settings")
     username = st.session_state.username
-    user = get_user(username)
+    ctx = current_request()
+    user = ctx.get_user(username)
     profile = user["profile"]
     visible_fields = user["visible_fields"]
 
@@ -39,6 +41,7 @@ def show_profile():
                 "avatar": avatar
             }
             update_profile(username, new_profile, visible)
+            ctx.invalidate("get_user", username)
             st.session_state.display_name = display_name or name
             st.session_state.avatar = avatar
             st.success("Profile updated!")
@@ -52,9 +55,11 @@ def show_profile():
             confirm = st.text_input("Type your username to confirm", type="password")
             delete_btn = st.form_submit_button("Delete Account")
             if delete_btn and confirm == username:
-                if delete_user(username):
+                job_id = delete_user(username)
+                if job_id:
+                    # Data is removed by a background job; the login page shows its progress
                     logout()
-                    st.success("Account deleted. You have been logged out.")
+                    st.session_state.deletion_job = job_id
                     st.rerun()
                 else:
                     st.error("Cannot delete admin account.")
@@ -1,10 +1,12 @@
 import streamlit as st
-from database import get_user, update_settings
+from database import update_settings
+from context import current_request
 
 def show_settings():
     st.title("Settings")
     username = st.session_state.username
-    user = get_user(username)
+    ctx = current_request()
+    user = ctx.get_user(username)
     settings = user.get("settings", {"theme": "light", "background_color": "#f0f0f0"})
 
     with st.form("settings_form"):
@@ -28,6 +30,7 @@ def show_settings():
                 "background_color": background_color
             }
             update_settings(username, new_settings)
+            ctx.invalidate("get_user", username)
             st.session_state.theme = new_settings["theme"]
             st.session_state.background_color = new_settings["background_color"]
             st.success("Settings saved!")